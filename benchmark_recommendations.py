@@ -0,0 +1,282 @@
+#run with python and not python3
+
+#Offline benchmark of the recommendation pipeline in machine_learning.py.
+#The pipeline runs end to end against an in-memory Firestore (or the local Firestore emulator)
+#filled with synthetic users, events and tickets shaped like the output of dummy_data_generator.py.
+#Every stage reports its wall time, its own peak RSS (sampled while it runs), the peak RSS of the process and its throughput.
+#
+#Examples:
+#python benchmark_recommendations.py --users 1000 10000
+#python benchmark_recommendations.py --users 100000 1000000 --engine als --skip-tickets --json results.json
+#FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmark_recommendations.py --backend emulator --users 1000
+#python benchmark_recommendations.py --users 10000 --service-qps 200 --service-seconds 20
+
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+import geohash
+import numpy as np
+
+import dummy_data_generator as generator
+from in_memory_firestore import InMemoryFirestore
+import machine_learning as ml
+import recommendation_service
+
+SCALES = [1000, 10000, 100000, 1000000]
+# Query service load: four in five requests go to the same fifth of the users
+SERVICE_HOT_FRACTION = 0.2
+SERVICE_HOT_SHARE = 0.8
+SERVICE_CLIENTS = 32
+
+# One event for every ten users, as in the generator (12 users, 120 events)
+def default_event_count(n_users):
+    return max(120, n_users // 10)
+
+def commit_in_batches(db, collection, documents):
+    batch = db.batch()
+    pending = 0
+    for document_id, document in documents:
+        batch.set(db.collection(collection).document(document_id), document)
+        pending += 1
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+
+def populate(db, n_users, n_events, with_tickets, seed):
+    random.seed(seed)
+    user_ids = [f'user{index:07d}' for index in range(n_users)]
+    event_ids = [f'event{index:07d}' for index in range(n_events)]
+    cities = list(generator.cities_and_streets)
+    prices = {}
+
+    def events():
+        for index, event_id in enumerate(event_ids):
+            city = cities[index % len(cities)]
+            creator_index = index % n_users
+            latitude, longitude = generator.CITY_CENTRES[city]
+            latitude += random.uniform(-0.05, 0.05)
+            longitude += random.uniform(-0.05, 0.05)
+            event = generator.dummy_event_document(
+                city, random.choice(generator.cities_and_streets[city]), user_ids[creator_index],
+                f'benchmark{creator_index}', latitude, longitude, geohash.encode(latitude, longitude),
+            )
+            event['eventID'] = event_id
+            prices[event_id] = generator.string_price_to_float(event['price'])
+            yield event_id, event
+
+    user_docs = {}
+
+    def users():
+        for index, user_id in enumerate(user_ids):
+            user = generator.dummy_user_document(f'benchmark{index}')
+            user.update(generator.dummy_interactions(event_ids))
+            if with_tickets:
+                user_docs[user_id] = user
+            yield user_id, user
+
+    def tickets():
+        for user_id, user in user_docs.items():
+            for event_id in user['myEvents']:
+                for ticket_num in range(random.randint(1, 3)):
+                    number_of_tickets = random.randint(1, 4)
+                    yield None, generator.dummy_ticket_document(user_id, event_id, user['username'], number_of_tickets, ticket_num == 0, prices[event_id] * number_of_tickets)
+
+    commit_in_batches(db, 'events', events())
+    commit_in_batches(db, 'Users', users())
+    if with_tickets:
+        commit_in_batches(db, 'tickets', tickets())
+
+def run_stage(results, stage, function, count):
+    start = time.perf_counter()
+    with ml.RSSSampler() as sampler:
+        value = function()
+    seconds = time.perf_counter() - start
+    items = count(value)
+    results.append({
+        'stage': stage,
+        'seconds': round(seconds, 3),
+        'items': items,
+        'items_per_second': round(items / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mib': sampler.peak,
+        'process_peak_rss_mib': ml.peak_rss_mib(),
+    })
+    return value
+
+def run_pipeline(db, engine, radius_km, results, verbose):
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with output, tempfile.TemporaryDirectory() as store_dir:
+        events_df, users_df = run_stage(
+            results, 'fetch',
+            lambda: (ml.fetch_events_to_dataframe(db), ml.fetch_users_to_dataframe(db)),
+            lambda frames: len(frames[0]) + len(frames[1]),
+        )
+        event_ids, event_features = run_stage(
+            results, 'encode',
+            lambda: ml.EventFeatureStore(store_dir).update(events_df),
+            lambda encoded: len(encoded[0]),
+        )
+        filtered_users_df, interaction_matrix = run_stage(
+            results, 'interaction build',
+            lambda: (lambda filtered: (filtered, ml.build_interaction_matrix(filtered, event_ids)))(ml.filter_users(users_df)),
+            lambda built: built[1].shape[0],
+        )
+        live_events = None
+        if ml.PREFILTER_EVENTS:
+            live_events = run_stage(results, 'prefilter', lambda: ml.live_event_mask(events_df, event_ids), lambda mask: int(mask.sum()))
+        candidate_index = None
+        if radius_km > 0:
+            candidate_index = run_stage(
+                results, 'spatial index',
+                lambda: ml.CandidateIndex(events_df, event_ids, radius_km=radius_km),
+                lambda index: len(index.located_positions),
+            )
+        recommendations = run_stage(
+            results, 'train/score',
+            lambda: list(ml.RECOMMENDATION_ENGINES[engine](filtered_users_df, event_ids, event_features, interaction_matrix, candidate_index=candidate_index, live_events=live_events)),
+            len,
+        )
+
+        def write():
+            writer = ml.HomeEventsWriter(db)
+            for user_doc_id, recommended_event_ids, scores in recommendations:
+                writer.add(user_doc_id, recommended_event_ids)
+            return writer.close()
+
+        run_stage(results, 'write', write, lambda stats: stats['succeeded'])
+
+#Open-loop load at a target rate: every request has a scheduled send time, and its latency is
+#measured from that time, so requests that queue behind slow ones count their wait
+def benchmark_service(db, engine, qps, seconds, seed, verbose):
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    with output, tempfile.TemporaryDirectory() as state_dir:
+        service = recommendation_service.RecommendationService(
+            db, engine, snapshot_dir=os.path.join(state_dir, 'snapshots'), state_path=os.path.join(state_dir, 'run_state.json'),
+            store_dir=os.path.join(state_dir, 'features'), metrics_path=os.path.join(state_dir, 'metrics.json'),
+        )
+        server = recommendation_service.make_server(service, '127.0.0.1', 0)
+        service.start()
+        serving = threading.Thread(target=server.serve_forever, daemon=True)
+        rounds = threading.Thread(target=service.run, kwargs={'checkpoint_seconds': float('inf')}, daemon=True)
+        serving.start()
+        rounds.start()
+        service.ready.wait()
+
+        base_url = f'http://127.0.0.1:{server.server_address[1]}/recommendations/'
+        user_ids = sorted(service.records['Users'])
+        hot_user_ids = user_ids[:max(1, int(len(user_ids) * SERVICE_HOT_FRACTION))]
+        rng = random.Random(seed)
+        latencies, cached = [], []
+
+        def request(scheduled, user_id):
+            with urllib.request.urlopen(base_url + urllib.parse.quote(user_id)) as response:
+                body = json.load(response)
+            latencies.append(time.perf_counter() - scheduled)
+            cached.append(body['cached'])
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=SERVICE_CLIENTS) as executor:
+            futures = []
+            for index in range(int(qps * seconds)):
+                scheduled = start + index / qps
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                user_id = rng.choice(hot_user_ids if rng.random() < SERVICE_HOT_SHARE else user_ids)
+                futures.append(executor.submit(request, scheduled, user_id))
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        service.stop()
+        rounds.join()
+        server.shutdown()
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        'engine': engine,
+        'target_qps': qps,
+        'achieved_qps': round(len(latencies) / elapsed, 1),
+        'requests': len(latencies),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 2),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 2),
+        'max_ms': round(float(latencies_ms.max()), 2),
+        'cache_hit_rate': round(sum(cached) / len(cached), 3),
+        'process_peak_rss_mib': ml.peak_rss_mib(),
+    }
+
+def make_database(backend):
+    if backend == 'emulator':
+        if 'FIRESTORE_EMULATOR_HOST' not in os.environ:
+            raise SystemExit('Set FIRESTORE_EMULATOR_HOST to use the emulator backend')
+        from google.cloud import firestore
+        return firestore.Client(project=os.environ.get('GCLOUD_PROJECT', 'eventsphere-benchmark'))
+    return InMemoryFirestore()
+
+def benchmark_scale(n_users, n_events, engine, radius_km, backend, with_tickets, seed, verbose, service_engine=None, service_qps=0, service_seconds=0):
+    db = make_database(backend)
+    results = []
+    run_stage(results, 'populate', lambda: populate(db, n_users, n_events, with_tickets, seed), lambda _: n_users + n_events)
+    run_pipeline(db, engine, radius_km, results, verbose)
+    report = {'users': n_users, 'events': n_events, 'engine': engine, 'radius_km': radius_km, 'backend': backend, 'stages': results}
+    if service_qps > 0:
+        report['service'] = benchmark_service(db, service_engine, service_qps, service_seconds, seed, verbose)
+    return report
+
+def print_report(report):
+    print(f"\n{report['users']} users, {report['events']} events ({report['engine']} engine, {report['backend']} backend)")
+    print(f"{'stage':<18}{'seconds':>10}{'items':>12}{'items/s':>14}{'peak RSS MiB':>15}{'process peak':>15}")
+    for stage in report['stages']:
+        print(f"{stage['stage']:<18}{stage['seconds']:>10.3f}{stage['items']:>12}{stage['items_per_second'] or 0:>14.1f}{stage['peak_rss_mib'] or 0:>15.1f}{stage['process_peak_rss_mib'] or 0:>15.1f}")
+    if 'service' in report:
+        service = report['service']
+        print(f"query service ({service['engine']} engine): {service['requests']} requests at {service['achieved_qps']} of {service['target_qps']} QPS, "
+              f"p50 {service['p50_ms']} ms, p99 {service['p99_ms']} ms, max {service['max_ms']} ms, cache hit rate {service['cache_hit_rate']:.1%}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the recommendation pipeline on synthetic data')
+    parser.add_argument('--users', type=int, nargs='+', default=SCALES[:2], help=f'user counts to benchmark (for example {SCALES})')
+    parser.add_argument('--events', type=int, help='number of events (default: one for every ten users, at least 120)')
+    parser.add_argument('--engine', default=ml.RECOMMENDATION_ENGINE, choices=sorted(ml.RECOMMENDATION_ENGINES))
+    parser.add_argument('--radius-km', type=float, default=ml.CANDIDATE_RADIUS_KM, help='geospatial candidate radius (0 scores every event)')
+    parser.add_argument('--backend', default='memory', choices=['memory', 'emulator'])
+    parser.add_argument('--skip-tickets', action='store_true', help='do not generate the tickets collection')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--service-qps', type=float, default=0, help='also load the query service at this rate (0 skips it)')
+    parser.add_argument('--service-seconds', type=float, default=10, help='duration of the query service load')
+    parser.add_argument('--service-engine', default=recommendation_service.SERVICE_ENGINE, choices=recommendation_service.SERVICE_ENGINES)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the pipeline')
+    args = parser.parse_args()
+
+    reports = []
+    for n_users in args.users:
+        n_events = args.events or default_event_count(n_users)
+        # Every scale runs in a fresh process, so its peak RSS is not inflated by the previous one
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            report = executor.submit(
+                benchmark_scale, n_users, n_events, args.engine, args.radius_km, args.backend, not args.skip_tickets, args.seed, args.verbose,
+                args.service_engine, args.service_qps, args.service_seconds,
+            ).result()
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(reports, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
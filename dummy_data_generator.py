@@ -1,5 +1,13 @@
 import firebase_admin
 from firebase_admin import credentials, firestore, auth
+import firebase_admin.exceptions
+from google.api_core import exceptions as google_exceptions
+from google.cloud import firestore as cloud_firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse
+import base64
 import random
 import string
 from random_username.generate import generate_username
@@ -8,8 +16,13 @@ import requests
 import urllib.parse
 import json
 from geopy.geocoders import Nominatim
+from geopy.extra.rate_limiter import RateLimiter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import geohash
+import hashlib
+import threading
 import subprocess
+import time
 import os
 
 # Use an environment variable for the Firebase Admin SDK JSON file path.
@@ -20,29 +33,330 @@ import os
 
 firebase_adminsdk_json_path = os.environ.get('FIREBASE_ADMINSDK_JSON', 'path/to/your/firebase-adminsdk.json')
 
-if not firebase_admin._apps:
-    cred = credentials.Certificate(firebase_adminsdk_json_path)
-    firebase_admin.initialize_app(cred)
+# The client is created in main(), so that the data helpers below can be imported
+# (for example by the benchmarks) without connecting to Firebase or wiping the database.
+db = None
+
+# Geocoding of the event addresses.
+# Resolved addresses are kept in GEOCODE_CACHE_PATH; committing that file makes seeding runs reproducible.
+# 'online' looks addresses up in the cache and resolves the misses with Nominatim.
+# 'offline' never uses the network: cache misses are placed near the city centre from CITY_CENTRES.
+GEOCODE_MODE = os.environ.get('GEOCODE_MODE', 'online')
+GEOCODE_CACHE_PATH = os.environ.get('GEOCODE_CACHE_PATH', 'geocode_cache.json')
+GEOCODE_WORKERS = int(os.environ.get('GEOCODE_WORKERS', '4'))
+# Nominatim's usage policy allows at most one request per second
+GEOCODE_REQUESTS_PER_SECOND = float(os.environ.get('GEOCODE_REQUESTS_PER_SECOND', '1'))
+
+# Auth accounts are imported and deleted in batches of up to 1000 (the limit of the Admin SDK),
+# with AUTH_WORKERS batches in flight. Firestore commits hold at most 500 writes.
+AUTH_BATCH_SIZE = 1000
+AUTH_WORKERS = int(os.environ.get('AUTH_WORKERS', '4'))
+# Imported passwords are stored as PBKDF2-SHA256 hashes with a salt per account, so the accounts can
+# sign in as usual. Every account is hashed on its own, so the rounds are kept low for the dummy data
+AUTH_PASSWORD_HASH_ROUNDS = int(os.environ.get('AUTH_PASSWORD_HASH_ROUNDS', '1000'))
+FIRESTORE_BATCH_SIZE = 500
+# Generated documents are written in batched commits on GENERATOR_WRITE_WORKERS threads
+GENERATOR_WRITE_WORKERS = int(os.environ.get('GENERATOR_WRITE_WORKERS', '8'))
+
+# Size of the generated data. The defaults give the original dataset: 12 users, 10 events in each
+# of the 12 cities (the first 3 of every city go to 'savedEvents'), 36 interactions per user and
+# 1 to 3 tickets for every booked event. GENERATOR_SEED makes the generated data repeatable.
+GENERATOR_USERS = int(os.environ.get('GENERATOR_USERS', '12'))
+GENERATOR_EVENTS_PER_CITY = int(os.environ.get('GENERATOR_EVENTS_PER_CITY', '10'))
+GENERATOR_SAVED_EVENTS_PER_CITY = 3
+GENERATOR_INTERACTIONS_PER_USER = int(os.environ.get('GENERATOR_INTERACTIONS_PER_USER', '36'))
+GENERATOR_TICKETS_PER_EVENT = int(os.environ.get('GENERATOR_TICKETS_PER_EVENT', '3'))
+GENERATOR_SEED = os.environ.get('GENERATOR_SEED')
+# Number of event documents requested per get_all call when prefetching ticket prices
+PRICE_PREFETCH_SIZE = 300
+
+# Wiping the collections before seeding.
+# WIPE_WORKERS bounds the delete commits in flight across all collections.
+# With WIPE_DRY_RUN=1 the generator only counts the documents that would be deleted, and stops.
+WIPED_COLLECTIONS = ['tickets', 'savedEvents', 'events', 'Users']
+WIPE_WORKERS = int(os.environ.get('WIPE_WORKERS', '8'))
+WIPE_DRY_RUN = os.environ.get('WIPE_DRY_RUN', '0') == '1'
+
+# Offline fixtures: 'export' writes the generated documents to FIXTURE_COLLECTIONS files in a
+# directory instead of Firebase, and 'load' streams such a directory into Firestore.
+# Every row holds the document id in FIXTURE_ID_FIELD. Timestamps are stored as {"$date": iso} in JSONL.
+FIXTURE_COLLECTIONS = ['auth', 'Users', 'events', 'savedEvents', 'tickets']
+FIXTURE_FORMATS = ['jsonl', 'parquet']
+FIXTURE_ID_FIELD = '_id'
+FIXTURE_ROWS_PER_FLUSH = 10000
+EVENT_FIXTURE_SCHEMA = pa.schema([
+    (FIXTURE_ID_FIELD, pa.string()),
+    ('availability', pa.int64()),
+    ('category', pa.string()),
+    ('city', pa.string()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('geohash', pa.string()),
+    ('creatorFirstLetter', pa.string()),
+    ('creatorId', pa.string()),
+    ('date', pa.timestamp('us')),
+    ('description', pa.string()),
+    ('header', pa.string()),
+    ('imageURL', pa.string()),
+    ('isDisabledFriendly', pa.bool_()),
+    ('overview', pa.string()),
+    ('price', pa.string()),
+    ('streetName', pa.string()),
+    ('streetNumber', pa.string()),
+    ('title', pa.string()),
+    ('eventID', pa.string()),
+])
+FIXTURE_SCHEMAS = {
+    'auth': pa.schema([
+        (FIXTURE_ID_FIELD, pa.string()),
+        ('email', pa.string()),
+        ('passwordHash', pa.string()),
+        ('passwordSalt', pa.string()),
+    ]),
+    'Users': pa.schema(
+        [(FIXTURE_ID_FIELD, pa.string()), ('email', pa.string()), ('username', pa.string())]
+        + [(field, pa.list_(pa.string())) for field in ['bookmarkedEvents', 'dislikedEvents', 'homeEvents', 'likedEvents', 'myEvents', 'publishedEvents', 'savedEvents']]
+    ),
+    'events': EVENT_FIXTURE_SCHEMA,
+    'savedEvents': EVENT_FIXTURE_SCHEMA,
+    'tickets': pa.schema([
+        (FIXTURE_ID_FIELD, pa.string()),
+        ('bookingDate', pa.timestamp('us')),
+        ('eventId', pa.string()),
+        ('fullName', pa.string()),
+        ('isValidated', pa.bool_()),
+        ('totalCost', pa.float64()),
+        ('totalTickets', pa.int64()),
+        ('userId', pa.string()),
+    ]),
+}
 
-db = firestore.client()
+geocoder = None
+# (directory, format) while exporting fixtures, None when writing to Firebase
+fixture_export = None
+# Fixed current time of an export, so that the generated dates do not depend on when it runs
+reference_time = None
+
+# With FIRESTORE_EMULATOR_HOST set, the local emulator is used and no service account is needed.
+# The auth emulator is used the same way when FIREBASE_AUTH_EMULATOR_HOST is set.
+def get_database():
+    if os.environ.get('FIRESTORE_EMULATOR_HOST'):
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(options={'projectId': os.environ.get('GCLOUD_PROJECT', 'eventsphere')})
+        return cloud_firestore.Client(project=os.environ.get('GCLOUD_PROJECT', 'eventsphere'))
+
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(firebase_adminsdk_json_path)
+        firebase_admin.initialize_app(cred)
+
+    return firestore.client()
+
+def now():
+    return reference_time or datetime.now()
+
+#Streams writes into batched commits that run on a small thread pool, with at most
+#2 * workers commits in flight. The outcome of every commit is reported.
+class BatchWriter:
+    def __init__(self, label, workers=GENERATOR_WRITE_WORKERS):
+        self.label = label
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = threading.BoundedSemaphore(2 * workers)
+        self.lock = threading.Lock()
+        self.batch = db.batch()
+        self.pending = 0
+        self.batches = 0
+        self.futures = []
+        self.written = 0
+        self.failed = 0
+
+    def set(self, collection, document_id, document_data):
+        self.batch.set(db.collection(collection).document(document_id), document_data)
+        self._added()
+
+    def close(self):
+        if self.pending:
+            self._submit()
+        for future in self.futures:
+            future.result()
+        self.executor.shutdown()
+        print(f'{self.label}: {self.written} documents written, {self.failed} failed')
+        return self.written
+
+    def _added(self):
+        self.pending += 1
+        if self.pending == FIRESTORE_BATCH_SIZE:
+            self._submit()
+
+    def _submit(self):
+        batch, size = self.batch, self.pending
+        self.batch = db.batch()
+        self.pending = 0
+        self.batches += 1
+        self.in_flight.acquire()
+        future = self.executor.submit(self._commit, self.batches, batch, size)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+    def _commit(self, batch_number, batch, size):
+        try:
+            batch.commit()
+        except google_exceptions.GoogleAPICallError as error:
+            print(f'{self.label} batch {batch_number}: could not write {size} documents: {error}')
+            with self.lock:
+                self.failed += size
+            return
+        with self.lock:
+            self.written += size
+            written = self.written
+        print(f'{self.label} batch {batch_number}: wrote {size} documents ({written} so far)')
+
+#Writes the generated documents to one fixture file per collection instead of Firestore
+class FixtureWriter:
+    def __init__(self, label, directory, file_format):
+        self.label = label
+        self.directory = directory
+        self.file_format = file_format
+        self.files = {}
+        self.pending = {}
+        self.written = 0
+
+    def set(self, collection, document_id, document_data):
+        rows = self.pending.setdefault(collection, [])
+        rows.append({FIXTURE_ID_FIELD: document_id, **document_data})
+        if len(rows) == FIXTURE_ROWS_PER_FLUSH:
+            self._flush(collection)
+
+    def close(self):
+        for collection in list(self.pending):
+            self._flush(collection)
+        for fixture_file in self.files.values():
+            fixture_file.close()
+        print(f'{self.label}: {self.written} documents exported')
+        return self.written
+
+    def _flush(self, collection):
+        rows = self.pending.pop(collection)
+        path = fixture_path(self.directory, collection, self.file_format)
+        if self.file_format == 'jsonl':
+            if collection not in self.files:
+                self.files[collection] = open(path, 'w')
+            for row in rows:
+                self.files[collection].write(json.dumps(row, default=encode_fixture_value, ensure_ascii=False) + '\n')
+        else:
+            if collection not in self.files:
+                self.files[collection] = pq.ParquetWriter(path, FIXTURE_SCHEMAS[collection])
+            self.files[collection].write_table(pa.Table.from_pylist(rows, schema=FIXTURE_SCHEMAS[collection]))
+        self.written += len(rows)
+
+def open_writer(label):
+    if fixture_export is not None:
+        return FixtureWriter(label, *fixture_export)
+    return BatchWriter(label)
+
+def fixture_path(directory, collection, file_format):
+    return os.path.join(directory, f'{collection}.{file_format}')
+
+def encode_fixture_value(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    raise TypeError(f'Cannot export {type(value).__name__} values')
+
+def decode_fixture_object(obj):
+    if obj.keys() == {'$date'}:
+        return datetime.fromisoformat(obj['$date'])
+    return obj
+
+#Yields the rows of a fixture file, FIRESTORE_BATCH_SIZE rows at a time for Parquet
+def read_fixture(path):
+    if path.endswith('.jsonl'):
+        with open(path) as fixture_file:
+            for line in fixture_file:
+                yield json.loads(line, object_hook=decode_fixture_object)
+    else:
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=FIRESTORE_BATCH_SIZE):
+            yield from record_batch.to_pylist()
+
+def in_batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield start // batch_size + 1, items[start:start + batch_size]
+
+#Runs one call per batch on AUTH_WORKERS threads and reports the outcome of every batch.
+#Returns the items that failed.
+def run_auth_batches(action, call, items, describe=str):
+    failed = []
+    with ThreadPoolExecutor(max_workers=AUTH_WORKERS) as executor:
+        futures = {executor.submit(call, batch): (batch_number, batch) for batch_number, batch in in_batches(items, AUTH_BATCH_SIZE)}
+        for future in as_completed(futures):
+            batch_number, batch = futures[future]
+            try:
+                result = future.result()
+            except firebase_admin.exceptions.FirebaseError as error:
+                print(f'Batch {batch_number}: could not {action} {len(batch)} users: {error}')
+                failed.extend(batch)
+                continue
+            print(f'Batch {batch_number}: {action} {result.success_count} users, {result.failure_count} failed')
+            for error in result.errors:
+                print(f'  {describe(batch[error.index])}: {error.reason}')
+                failed.append(batch[error.index])
+    return failed
 
 def delete_all_auth_users():
-    all_users = auth.list_users().iterate_all()
-    for user in all_users:
-        auth.delete_user(user.uid)
-        print(f'Deleted user {user.uid}')
-
-delete_all_auth_users()
-
-def delete_collection(collection):
-    docs = db.collection(collection).stream()
-    for doc in docs:
-        db.collection(collection).document(doc.id).delete()
-
-delete_collection('tickets')
-delete_collection('savedEvents') 
-delete_collection('events')  
-delete_collection('Users')
+    uids = [user.uid for user in auth.list_users().iterate_all()]
+    failed = run_auth_batches('delete', auth.delete_users, uids)
+    print(f'Deleted {len(uids) - len(failed)} of {len(uids)} auth users')
+
+#Pages through the document ids only (no fields are read) and deletes every page in one
+#batched commit on the shared executor. Deleted documents are gone for good, so a wipe that
+#was interrupted is resumed by running it again: it starts over on what is left.
+def delete_collection(collection, executor, in_flight):
+    query = (
+        db.collection(collection)
+        .select([FieldPath.document_id()])
+        .order_by(FieldPath.document_id())
+        .limit(FIRESTORE_BATCH_SIZE)
+    )
+    futures = []
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page_query.stream())
+        if docs:
+            in_flight.acquire()
+            future = executor.submit(delete_documents, collection, [doc.reference for doc in docs])
+            future.add_done_callback(lambda _: in_flight.release())
+            futures.append(future)
+        if len(docs) < FIRESTORE_BATCH_SIZE:
+            break
+        last_doc = docs[-1]
+
+    deleted = sum(future.result() for future in futures)
+    print(f"Deleted {deleted} documents from '{collection}'")
+    return deleted
+
+def delete_documents(collection, references):
+    batch = db.batch()
+    for reference in references:
+        batch.delete(reference)
+    try:
+        batch.commit()
+    except google_exceptions.GoogleAPICallError as error:
+        print(f"Could not delete a batch of {len(references)} documents from '{collection}': {error}")
+        return 0
+    return len(references)
+
+def count_collection(collection):
+    return db.collection(collection).count().get()[0][0].value
+
+def wipe_collections(collections, dry_run=False):
+    if dry_run:
+        for collection in collections:
+            print(f"Would delete {count_collection(collection)} documents from '{collection}'")
+        return
+
+    in_flight = threading.BoundedSemaphore(2 * WIPE_WORKERS)
+    with ThreadPoolExecutor(max_workers=WIPE_WORKERS) as executor, ThreadPoolExecutor(max_workers=len(collections)) as collection_executor:
+        deleted = sum(collection_executor.map(lambda collection: delete_collection(collection, executor, in_flight), collections))
+    print(f"Deleted {deleted} documents from {len(collections)} collections")
 
 
 '''def get_streets():
@@ -124,7 +438,7 @@ def random_firebase_timestamp():
     random_hour = random.randint(0, 23)
     random_minute = random.choice([0, 15, 30, 45])
 
-    future_date = datetime.now() + timedelta(days=random_days)
+    future_date = now() + timedelta(days=random_days)
     random_date_with_time = future_date.replace(hour=random_hour, minute=random_minute, second=0, microsecond=0)
 
     return random_date_with_time
@@ -224,19 +538,93 @@ def generate_event_overview():
     return overview
 
 
-def create_dummy_event(city, street, user_id, username):
-    event_title = generate_event_title()
-    first_letter = username[0].upper()
+# Approximate centre of every city, used by the offline geocoding mode
+CITY_CENTRES = {
+    'Athens': (37.98, 23.73),
+    'Patras': (38.25, 21.73),
+    'Thessaloniki': (40.64, 22.94),
+    'Seattle': (47.61, -122.33),
+    'Toronto': (43.65, -79.38),
+    'Paris': (48.86, 2.35),
+    'London': (51.51, -0.13),
+    'Madrid': (40.42, -3.70),
+    'Rome': (41.90, 12.50),
+    'Berlin': (52.52, 13.40),
+    'Amsterdam': (52.37, 4.90),
+    'Sydney': (-33.87, 151.21),
+}
+
+# A point near the city centre, always the same for the same address
+def offline_location(street, city):
+    if city not in CITY_CENTRES:
+        return None
+    digest = hashlib.blake2b(f"{street}, {city}".encode(), digest_size=4).digest()
+    latitude_offset = int.from_bytes(digest[:2], 'big') / 65535 * 0.1 - 0.05
+    longitude_offset = int.from_bytes(digest[2:], 'big') / 65535 * 0.1 - 0.05
+    latitude, longitude = CITY_CENTRES[city]
+    return latitude + latitude_offset, longitude + longitude_offset
+
+#One geolocator for the whole run. Cache misses are resolved on a few threads that share
+#the rate limit. Addresses that were not found are cached too, failed requests are not.
+class Geocoder:
+    def __init__(self, mode=GEOCODE_MODE, cache_path=GEOCODE_CACHE_PATH, workers=GEOCODE_WORKERS, requests_per_second=GEOCODE_REQUESTS_PER_SECOND):
+        if mode not in ('online', 'offline'):
+            raise ValueError(f"Unknown GEOCODE_MODE '{mode}', expected 'online' or 'offline'")
+        self.mode = mode
+        self.cache_path = cache_path
+        self.workers = workers
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                self.cache = json.load(cache_file)
+        self.geocode = None
+        if mode == 'online':
+            geolocator = Nominatim(user_agent="dummy_event_generator")
+            min_delay = 1 / requests_per_second
+            self.geocode = RateLimiter(geolocator.geocode, min_delay_seconds=min_delay, error_wait_seconds=max(5, min_delay), return_value_on_exception=False)
+
+    def resolve_all(self, addresses):
+        missing = sorted({(street, city) for street, city in addresses if f"{street}, {city}" not in self.cache})
+        if not missing or self.mode == 'offline':
+            return
+        print(f"Geocoding {len(missing)} addresses")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            locations = executor.map(lambda address: self.geocode(f"{address[0]}, {address[1]}"), missing)
+            for (street, city), location in zip(missing, locations):
+                if location is False:
+                    print(f"Could not geocode {street}, {city}")
+                    continue
+                self.cache[f"{street}, {city}"] = [location.latitude, location.longitude] if location else None
+        self.save()
+
+    def locate(self, street, city):
+        address = f"{street}, {city}"
+        if address not in self.cache:
+            if self.mode == 'offline':
+                return offline_location(street, city)
+            self.resolve_all([(street, city)])
+        return self.cache.get(address)
+
+    def save(self):
+        with open(self.cache_path + '.tmp', 'w') as cache_file:
+            json.dump(self.cache, cache_file, indent=1, sort_keys=True, ensure_ascii=False)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
 
-    geolocator = Nominatim(user_agent="dummy_event_generator")
-    address = f"{street}, {city}"
-    location = geolocator.geocode(address)
+
+def create_dummy_event(city, street, user_id, username):
+    location = geocoder.locate(street, city)
     
-    latitude = location.latitude if location else 0
-    longitude = location.longitude if location else 0
+    latitude = location[0] if location else 0
+    longitude = location[1] if location else 0
     
     event_geohash = geohash.encode(latitude, longitude) if location else "0"
-    
+
+    return dummy_event_document(city, street, user_id, username, latitude, longitude, event_geohash)
+
+def dummy_event_document(city, street, user_id, username, latitude, longitude, event_geohash):
+    event_title = generate_event_title()
+    first_letter = username[0].upper()
+
     dummy_event = {
         'availability': random.randint(20, 300), 
         'category': random.choice(categories),
@@ -259,13 +647,51 @@ def create_dummy_event(city, street, user_id, username):
     }
     return dummy_event
 
-def create_dummy_user(username, password):
-    user_record = auth.create_user(
-        email=f'{username}@gmail.com',
-        password=password
-    )
-    print('Successfully created new user:', user_record.uid)
+def generate_uid():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=28))
+
+# Ids are drawn here instead of by the client library, so that seeded runs get the same ids
+def generate_document_id():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+
+# Every account gets its own salt, so accounts sharing a password do not share a hash
+def hash_password(password):
+    salt = random.randbytes(16)
+    return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, AUTH_PASSWORD_HASH_ROUNDS), salt
+
+def import_user_record(uid, username, password):
+    password_hash, salt = hash_password(password)
+    return auth.ImportUserRecord(uid=uid, email=f'{username}@gmail.com', password_hash=password_hash, password_salt=salt)
+
+def import_auth_users(records):
+    hash_alg = auth.UserImportHash.pbkdf2_sha256(rounds=AUTH_PASSWORD_HASH_ROUNDS)
+    return run_auth_batches('import', lambda batch: auth.import_users(batch, hash_alg=hash_alg), records, describe=lambda record: record.email)
+
+def export_auth_users(records):
+    writer = open_writer('Auth users')
+    for record in records:
+        writer.set('auth', record.uid, {
+            'email': record.email,
+            'passwordHash': base64.b64encode(record.password_hash).decode(),
+            'passwordSalt': base64.b64encode(record.password_salt).decode(),
+        })
+    writer.close()
+
+#Creates the auth accounts for a list of (username, password), or exports them as fixtures.
+#Users whose account could not be created are left out of the result. Their 'Users' documents
+#are written later, together with their events and interactions.
+def create_dummy_users(usernames_and_passwords):
+    records = [import_user_record(generate_uid(), username, password) for username, password in usernames_and_passwords]
+    if fixture_export is not None:
+        export_auth_users(records)
+        failed_uids = set()
+    else:
+        failed_uids = {record.uid for record in import_auth_users(records)}
+
+    created = [(record.uid, dummy_user_document(username)) for record, (username, _) in zip(records, usernames_and_passwords) if record.uid not in failed_uids]
+    return [user_id for user_id, _ in created], [user for _, user in created]
 
+def dummy_user_document(username):
     dummy_user = {
         'bookmarkedEvents': [],
         'dislikedEvents': [],
@@ -277,155 +703,272 @@ def create_dummy_user(username, password):
         'savedEvents': [],
         'username': username
     }
-    new_user_ref = db.collection('Users').document(user_record.uid).set(dummy_user)
-    return user_record.uid, dummy_user
+    return dummy_user
 
 dummy_password = '123456'
-user_ids = []
-username = 'antonis7polo'
-antonis_user_id, antonis_user = create_dummy_user(username, 'abc123')
-user_ids.append(antonis_user_id)
-username = 'nikolasbv10'
-nikolas_user_id, nikolas_user = create_dummy_user(username, dummy_password)
-user_ids.append(nikolas_user_id)
-username = 'harrypap'
-harry_user_id, harry_user = create_dummy_user(username, dummy_password)
-user_ids.append(harry_user_id)
-users = [antonis_user, nikolas_user, harry_user]
-for _ in range(9):
-    username = generate_username(1)
-    dummy_user_id, dummy_user = create_dummy_user(username[0], dummy_password)
-    user_ids.append(dummy_user_id)
-    users.append(dummy_user)
-
-
-event_count_per_city = {city: 0 for city in cities_and_streets.keys()}
-
-if len(user_ids) >= len(cities_and_streets):
-    for user_id, user, city in zip(user_ids, users, cities_and_streets.keys()):
-        username = user['username']
-        streets = cities_and_streets[city]
-        
-        print(f"User ID: {user_id} is creating events for {city}:")
-        
-        user_ref = db.collection('Users').document(user_id)
-
-        for street in streets:
-            event = create_dummy_event(city, street, user_id, username)
-
-            if event_count_per_city[city] < 3:
-                event_ref = db.collection('savedEvents').add(event)
-                event_id = event_ref[1].id
-                event['eventID'] = event_id
-                new_event_ref = db.collection('savedEvents').document(event_id).set(event)
-                
-                user_ref.update({'savedEvents': firestore.ArrayUnion([event_id])})
-                
-                event_count_per_city[city] += 1
-                
-            else:
-                event_ref = db.collection('events').add(event)
-                event_id = event_ref[1].id
-                event['eventID'] = event_id
-                new_event_ref = db.collection('events').document(event_id).set(event)
-                
-                user_ref.update({'publishedEvents': firestore.ArrayUnion([event_id])})
-
-            print(f"  Created event: {event['title']} at {street}, {city}")
-else:
-    print("Not enough users to cover all cities")
-
-
-def update_user_attributes(user_id, all_event_ids):
-    random.shuffle(all_event_ids)
 
-    selected_event_ids = random.sample(all_event_ids, 36)
-
-    disliked_events = selected_event_ids[:10]
-    liked_events = selected_event_ids[10:24]
-    bookmarked_events = selected_event_ids[24:26]
-    bookmarked_and_liked_events = selected_event_ids[26:32]
-    my_events_and_liked_events = selected_event_ids[32:34]
-    my_events_all = selected_event_ids[34:36]
-
-    user_ref = db.collection('Users').document(user_id)
-    
-    user_ref.update({
-        'dislikedEvents': firestore.ArrayUnion(disliked_events),
-        'likedEvents': firestore.ArrayUnion(liked_events + bookmarked_and_liked_events + my_events_and_liked_events + my_events_all),
-        'bookmarkedEvents': firestore.ArrayUnion(bookmarked_events + bookmarked_and_liked_events + my_events_all),
-        'myEvents': firestore.ArrayUnion(my_events_all + my_events_and_liked_events)
-    })
-    
-def get_all_event_ids():
-    event_ids = []
-    events_ref = db.collection('events')
-
-    for event_doc in events_ref.stream():
-        event_ids.append(event_doc.id)
-    
-    return event_ids
+def create_users(total_users=GENERATOR_USERS):
+    usernames_and_passwords = [('antonis7polo', 'abc123'), ('nikolasbv10', dummy_password), ('harrypap', dummy_password)]
+    usernames = {username for username, _ in usernames_and_passwords}
+    while len(usernames_and_passwords) < total_users:
+        # Emails must be unique, so repeated usernames are drawn again
+        for username in generate_username(total_users - len(usernames_and_passwords)):
+            if username not in usernames:
+                usernames.add(username)
+                usernames_and_passwords.append((username, dummy_password))
+    return create_dummy_users(usernames_and_passwords)
+
+#Every event is written once, with an id drawn up front. The cities take turns over the users,
+#so with the default sizes every user creates the events of one city, and at larger sizes no
+#user ends up with more published events than fit in a document.
+#Returns the ids of the 'events' documents, and the published and saved events of every user.
+def create_events(user_ids, users, events_per_city=GENERATOR_EVENTS_PER_CITY):
+    geocoder.resolve_all([(street, city) for city, streets in cities_and_streets.items() for street in streets])
+
+    all_event_ids = []
+    user_events = {user_id: {'publishedEvents': [], 'savedEvents': []} for user_id in user_ids}
+    writer = open_writer('Events')
+
+    for city_index, (city, streets) in enumerate(cities_and_streets.items()):
+        for event_index in range(events_per_city):
+            creator_index = (city_index + event_index * len(cities_and_streets)) % len(user_ids)
+            user_id = user_ids[creator_index]
+            event = create_dummy_event(city, streets[event_index % len(streets)], user_id, users[creator_index]['username'])
+
+            event_id = generate_document_id()
+            if event_index < GENERATOR_SAVED_EVENTS_PER_CITY:
+                collection = 'savedEvents'
+                user_events[user_id]['savedEvents'].append(event_id)
+            else:
+                collection = 'events'
+                user_events[user_id]['publishedEvents'].append(event_id)
+                all_event_ids.append(event_id)
+                # Tickets are only booked for these, and their price is already known
+                event_prices[event_id] = string_price_to_float(event['price'])
+
+            event['eventID'] = event_id
+            writer.set(collection, event_id, event)
+
+        print(f"Created {events_per_city} events for {city}")
+
+    writer.close()
+    return all_event_ids, user_events
+
+#One write per user, with their published and saved events and their interactions.
+#Returns the attributes of every user.
+def write_user_documents(user_ids, users, user_events, all_event_ids, interactions_per_user=GENERATOR_INTERACTIONS_PER_USER):
+    writer = open_writer('Users')
+    user_attributes = {}
+    for user_id, user in zip(user_ids, users):
+        user_attributes[user_id] = {**user_events[user_id], **dummy_interactions(all_event_ids, interactions_per_user)}
+        writer.set('Users', user_id, {**user, **user_attributes[user_id]})
+    writer.close()
+    return user_attributes
+
+#The selected events are split in the proportions of the original 36 interactions:
+#10 disliked, 14 liked, 2 bookmarked, 6 bookmarked and liked, 2 booked and liked, 2 booked, liked and bookmarked
+def dummy_interactions(all_event_ids, count=36):
+    selected_event_ids = random.sample(all_event_ids, min(count, len(all_event_ids)))
+    bounds = [round(len(selected_event_ids) * bound / 36) for bound in (10, 24, 26, 32, 34)]
+
+    disliked_events = selected_event_ids[:bounds[0]]
+    liked_events = selected_event_ids[bounds[0]:bounds[1]]
+    bookmarked_events = selected_event_ids[bounds[1]:bounds[2]]
+    bookmarked_and_liked_events = selected_event_ids[bounds[2]:bounds[3]]
+    my_events_and_liked_events = selected_event_ids[bounds[3]:bounds[4]]
+    my_events_all = selected_event_ids[bounds[4]:]
+
+    return {
+        'dislikedEvents': disliked_events,
+        'likedEvents': liked_events + bookmarked_and_liked_events + my_events_and_liked_events + my_events_all,
+        'bookmarkedEvents': bookmarked_events + bookmarked_and_liked_events + my_events_all,
+        'myEvents': my_events_all + my_events_and_liked_events
+    }
     
-all_event_ids = get_all_event_ids()
-for user_id in user_ids:
-    update_user_attributes(user_id, all_event_ids)
-
 def string_price_to_float(price_str):
     if price_str.lower() == 'free':
         return 0.0
     else:
         return float(price_str.replace('$', '').replace('€', '').replace('£', ''))
 
-def create_ticket_for_event(user_id, event_id, username, number_of_tickets, is_validated):
-    event_ref = db.collection('events').document(event_id)
-    event = event_ref.get()
-    if event.exists:
-        event_data = event.to_dict()
-        price_str = event_data.get('price', '0')
-        price = string_price_to_float(price_str)
-        
+# Parsed price of every event read so far, or None for events that do not exist
+event_prices = {}
+
+#Reads the price of every event that is not in event_prices yet, PRICE_PREFETCH_SIZE events per get_all.
+#Events created in this run are already there.
+def prefetch_event_prices(event_ids):
+    missing = list(dict.fromkeys(event_id for event_id in event_ids if event_id not in event_prices))
+    if not missing:
+        return
+    for _, batch_ids in in_batches(missing, PRICE_PREFETCH_SIZE):
+        references = [db.collection('events').document(event_id) for event_id in batch_ids]
+        for event in db.get_all(references, field_paths=['price']):
+            event_prices[event.id] = string_price_to_float(event.get('price') or '0') if event.exists else None
+    print(f'Prefetched the prices of {len(missing)} events')
+
+def create_ticket_for_event(writer, user_id, event_id, username, number_of_tickets, is_validated):
+    price = event_prices.get(event_id)
+    if price is not None:
         total_cost = price * number_of_tickets
 
-        ticket_data = {
-            'bookingDate': datetime.now(),
-            'eventId': event_id,
-            'fullName': username,
-            'isValidated': is_validated,
-            'totalCost': round(total_cost, 2),
-            'totalTickets': number_of_tickets,
-            'userId': user_id
-        }
-
-        db.collection('tickets').add(ticket_data)
-        print(f'Ticket created for user {user_id} for event {event_id}')
-        
+        ticket_data = dummy_ticket_document(user_id, event_id, username, number_of_tickets, is_validated, total_cost)
 
-def create_tickets_for_user_events(user_id, username):
-    user_ref = db.collection('Users').document(user_id)
-    user = user_ref.get()
-    if user.exists:
-        user_data = user.to_dict()
-        my_events = user_data.get('myEvents', [])
-        for event_id in my_events:
-            total_tickets = random.randint(1, 3)
-            for ticket_num in range(total_tickets):
-                is_validated = False
-                if total_tickets > 1 and ticket_num == 0:
-                    is_validated = True
-                number_of_tickets = random.randint(1,4)
-                create_ticket_for_event(user_id, event_id, username, number_of_tickets, is_validated)
-                
-            print(f"Created {total_tickets} tickets for event {event_id} for user {user_id}")
-            
-for user_id in user_ids:
-    user_ref = db.collection('Users').document(user_id)
-    user_doc = user_ref.get()
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
-        username = user_data['username']
-        create_tickets_for_user_events(user_id, username)
+        writer.set('tickets', generate_document_id(), ticket_data)
+
+def dummy_ticket_document(user_id, event_id, username, number_of_tickets, is_validated, total_cost):
+    return {
+        'bookingDate': now(),
+        'eventId': event_id,
+        'fullName': username,
+        'isValidated': is_validated,
+        'totalCost': round(total_cost, 2),
+        'totalTickets': number_of_tickets,
+        'userId': user_id
+    }
         
 
-script_path = 'machine_learning.py'
-subprocess.run(['python', script_path])
+def create_tickets_for_user_events(writer, user_id, username, my_events):
+    for event_id in my_events:
+        total_tickets = random.randint(1, GENERATOR_TICKETS_PER_EVENT)
+        for ticket_num in range(total_tickets):
+            is_validated = False
+            if total_tickets > 1 and ticket_num == 0:
+                is_validated = True
+            number_of_tickets = random.randint(1,4)
+            create_ticket_for_event(writer, user_id, event_id, username, number_of_tickets, is_validated)
+
+#Ticket seeding reads every booked event once and writes the tickets in batched commits
+def create_tickets(user_ids, users, user_attributes):
+    prefetch_event_prices(event_id for user_id in user_ids for event_id in user_attributes[user_id]['myEvents'])
+
+    writer = open_writer('Tickets')
+    for user_id, user in zip(user_ids, users):
+        create_tickets_for_user_events(writer, user_id, user['username'], user_attributes[user_id]['myEvents'])
+    writer.close()
+
+def generate_dataset():
+    user_ids, users = create_users()
+    all_event_ids, user_events = create_events(user_ids, users)
+    user_attributes = write_user_documents(user_ids, users, user_events, all_event_ids)
+    create_tickets(user_ids, users, user_attributes)
+
+#Offline fixtures
+#An export never touches Firebase or the network: addresses come from the geocoding cache or
+#the city centres, and with the same seed and reference date the files are the same every time.
+def export_fixtures(directory, file_format, seed, reference_date):
+    global geocoder, fixture_export, reference_time
+    os.makedirs(directory, exist_ok=True)
+    geocoder = Geocoder(mode='offline')
+    fixture_export = (directory, file_format)
+    reference_time = datetime.combine(reference_date, datetime.min.time())
+    random.seed(seed)
+    generate_dataset()
+    print(f'Exported the dataset to {directory}')
+
+def fixture_files(directory):
+    for collection in FIXTURE_COLLECTIONS:
+        for file_format in FIXTURE_FORMATS:
+            path = fixture_path(directory, collection, file_format)
+            if os.path.exists(path):
+                yield collection, path
+
+#Streams a fixture directory into Firestore (or the emulator) with batched commits, after
+#importing the auth accounts. The collections are expected to be empty.
+def load_fixtures(directory, import_auth=True):
+    global db
+    db = get_database()
+
+    for collection, path in fixture_files(directory):
+        if collection == 'auth':
+            if import_auth:
+                load_auth_fixture(path)
+            continue
+
+        writer = BatchWriter(collection)
+        for row in read_fixture(path):
+            document_id = row.pop(FIXTURE_ID_FIELD)
+            writer.set(collection, document_id, row)
+        writer.close()
+
+def load_auth_fixture(path):
+    records = []
+    for row in read_fixture(path):
+        records.append(auth.ImportUserRecord(
+            uid=row[FIXTURE_ID_FIELD],
+            email=row['email'],
+            password_hash=base64.b64decode(row['passwordHash']),
+            password_salt=base64.b64decode(row['passwordSalt']),
+        ))
+        if len(records) == AUTH_BATCH_SIZE * AUTH_WORKERS:
+            import_auth_users(records)
+            records = []
+    if records:
+        import_auth_users(records)
+
+#Turns the events and Users fixtures into the snapshots read by
+#RECOMMENDATION_SNAPSHOT_MODE=offline in machine_learning.py
+def write_recommendation_snapshots(directory, snapshot_dir):
+    import machine_learning as ml
+    import pandas as pd
+
+    update_time = time.time()
+    for collection, path in fixture_files(directory):
+        if collection not in ml.COLLECTION_SCHEMAS:
+            continue
+        fields = ml.COLLECTION_SCHEMAS[collection].names
+        records = [
+            {**{field: row.get(field) for field in fields}, 'id': row[FIXTURE_ID_FIELD], 'updateTime': update_time}
+            for row in read_fixture(path)
+        ]
+        ml.write_snapshot(collection, pd.DataFrame(records), snapshot_dir)
+        print(f"Snapshot of '{collection}': {len(records)} documents written to {snapshot_dir}")
+
+def seed_firebase():
+    global db, geocoder
+    db = get_database()
+
+    if WIPE_DRY_RUN:
+        wipe_collections(WIPED_COLLECTIONS, dry_run=True)
+        return
+
+    geocoder = Geocoder()
+    if GENERATOR_SEED is not None:
+        random.seed(int(GENERATOR_SEED))
+
+    delete_all_auth_users()
+    wipe_collections(WIPED_COLLECTIONS)
+    generate_dataset()
+
+    script_path = 'machine_learning.py'
+    subprocess.run(['python', script_path])
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the EventSphere dummy data')
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser('export', help='write the dataset to fixture files, without Firebase')
+    export_parser.add_argument('directory')
+    export_parser.add_argument('--format', default='jsonl', choices=FIXTURE_FORMATS)
+    export_parser.add_argument('--seed', type=int, default=int(GENERATOR_SEED or 0))
+    export_parser.add_argument('--reference-date', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(), default=datetime.now().date(),
+                               help='the day the event and booking dates are generated from (default: today)')
+    load_parser = commands.add_parser('load', help='load fixture files into Firestore or the emulator')
+    load_parser.add_argument('directory')
+    load_parser.add_argument('--skip-auth', action='store_true', help='do not import the auth accounts')
+    snapshot_parser = commands.add_parser('snapshots', help='turn fixture files into snapshots for the recommendation offline mode')
+    snapshot_parser.add_argument('directory')
+    snapshot_parser.add_argument('--snapshot-dir', default=os.environ.get('RECOMMENDATION_SNAPSHOT_DIR', os.path.join('.recommendation_state', 'snapshots')))
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_fixtures(args.directory, args.format, args.seed, args.reference_date)
+    elif args.command == 'load':
+        load_fixtures(args.directory, import_auth=not args.skip_auth)
+    elif args.command == 'snapshots':
+        write_recommendation_snapshots(args.directory, args.snapshot_dir)
+    else:
+        seed_firebase()
+
+
+if __name__ == '__main__':
+    main()
             
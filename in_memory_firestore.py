@@ -0,0 +1,276 @@
+#In-memory stand-in for the parts of the Firestore client that machine_learning.py and
+#dummy_data_generator.py use, so the pipeline can run without a Firebase project.
+#Documents are kept in plain dicts and every write gets a strictly increasing update time.
+
+from datetime import datetime, timezone
+import itertools
+import queue
+import random
+import string
+import threading
+
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+
+class InMemoryFirestore:
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.RLock()
+        self._clock = itertools.count(int(datetime.now(timezone.utc).timestamp() * 1_000_000))
+        self._watches = []
+        self.reads = 0
+        self.writes = 0
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references, field_paths=None):
+        for reference in references:
+            yield reference.get(field_paths=field_paths)
+
+    def _documents(self, collection):
+        return self._collections.setdefault(collection, {})
+
+    def _now(self):
+        return datetime.fromtimestamp(next(self._clock) / 1_000_000, timezone.utc)
+
+    def _apply(self, operations):
+        with self._lock:
+            for kind, reference, data, options in operations:
+                if kind == 'update' and reference.id not in self._documents(reference.collection):
+                    raise google_exceptions.NotFound(f'No document to update: {reference.path}')
+
+            update_time = self._now()
+            existed = {}
+            for kind, reference, data, options in operations:
+                documents = self._documents(reference.collection)
+                existed.setdefault(reference.path, (reference, reference.id in documents))
+                if kind == 'delete':
+                    documents.pop(reference.id, None)
+                    continue
+
+                if kind == 'set' and not options.get('merge'):
+                    stored = {}
+                else:
+                    stored = dict(documents.get(reference.id, ({}, None))[0])
+                for field, value in data.items():
+                    _apply_field(stored, field, value, update_time)
+                documents[reference.id] = (stored, update_time)
+            self.writes += len(operations)
+
+            changed = []
+            for reference, existed_before in existed.values():
+                exists = reference.id in self._documents(reference.collection)
+                if exists or existed_before:
+                    changed.append((reference, ChangeType.REMOVED if not exists else ChangeType.MODIFIED if existed_before else ChangeType.ADDED))
+            for watch in self._watches:
+                watch._notify([(reference, change_type) for reference, change_type in changed if reference.collection == watch._collection], update_time)
+        return update_time
+
+
+def _apply_field(stored, field, value, update_time):
+    if value is transforms.DELETE_FIELD:
+        stored.pop(field, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        stored[field] = update_time
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(stored.get(field) or [])
+        stored[field] = current + [item for item in value.values if item not in current]
+    elif isinstance(value, transforms.ArrayRemove):
+        stored[field] = [item for item in stored.get(field) or [] if item not in value.values]
+    else:
+        stored[field] = value
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, update_time, field_paths=None):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+        self._field_paths = field_paths
+
+    def to_dict(self):
+        if self._data is None:
+            return None
+        fields = self._data if self._field_paths is None else [field for field in self._field_paths if field in self._data]
+        return {field: list(self._data[field]) if isinstance(self._data[field], list) else self._data[field] for field in fields}
+
+    def get(self, field):
+        return self.to_dict().get(field)
+
+
+class DocumentReference:
+    def __init__(self, db, collection, document_id):
+        self._db = db
+        self.collection = collection
+        self.id = document_id
+        self.path = f'{collection}/{document_id}'
+
+    def get(self, field_paths=None):
+        with self._db._lock:
+            data, update_time = self._db._documents(self.collection).get(self.id, (None, None))
+            self._db.reads += 1
+        return DocumentSnapshot(self, data, update_time, field_paths)
+
+    def set(self, document_data, merge=False):
+        return self._db._apply([('set', self, document_data, {'merge': merge})])
+
+    def update(self, field_updates):
+        return self._db._apply([('update', self, field_updates, {})])
+
+    def delete(self):
+        return self._db._apply([('delete', self, {}, {})])
+
+
+class Query:
+    def __init__(self, db, collection, field_paths=None, limit=None, start_after=None):
+        self._db = db
+        self._collection = collection
+        self._field_paths = field_paths
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        options = {'field_paths': self._field_paths, 'limit': self._limit, 'start_after': self._start_after}
+        options.update(changes)
+        return Query(self._db, self._collection, **options)
+
+    def select(self, field_paths):
+        return self._copy(field_paths=[field for field in field_paths if field != FieldPath.document_id()])
+
+    # Documents are always returned in document id order, which is Firestore's default order
+    def order_by(self, field_path, direction=None):
+        if field_path != FieldPath.document_id():
+            raise NotImplementedError('The in-memory Firestore only orders by document id')
+        return self
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document):
+        document_id = document.id if isinstance(document, DocumentSnapshot) else document[FieldPath.document_id()]
+        return self._copy(start_after=document_id)
+
+    def stream(self):
+        with self._db._lock:
+            documents = self._db._documents(self._collection)
+            document_ids = sorted(documents)
+            if self._start_after is not None:
+                document_ids = [document_id for document_id in document_ids if document_id > self._start_after]
+            if self._limit is not None:
+                document_ids = document_ids[:self._limit]
+            snapshots = [
+                DocumentSnapshot(DocumentReference(self._db, self._collection, document_id), *documents[document_id], self._field_paths)
+                for document_id in document_ids
+            ]
+            self._db.reads += len(snapshots)
+        return iter(snapshots)
+
+    def get(self):
+        return list(self.stream())
+
+    def count(self, alias=None):
+        return CountQuery(self, alias)
+
+    def on_snapshot(self, callback):
+        return Watch(self._db, self._collection, callback)
+
+
+class CountQuery:
+    def __init__(self, query, alias):
+        self._query = query
+        self._alias = alias
+
+    # Firestore returns one list of aggregation results per query
+    def get(self):
+        return [[AggregationResult(self._alias, len(self._query.get()))]]
+
+
+class AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class CollectionReference(Query):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.id = name
+
+    def document(self, document_id=None):
+        if document_id is None:
+            document_id = ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+        return DocumentReference(self._db, self._collection, document_id)
+
+    def add(self, document_data, document_id=None):
+        reference = self.document(document_id)
+        return reference.set(document_data), reference
+
+
+#Listener on a whole collection. As with Firestore, the callback runs on a background thread,
+#first with every document as ADDED and then once for every commit that changes the collection.
+class Watch:
+    def __init__(self, db, collection, callback):
+        self._db = db
+        self._collection = collection
+        self._callback = callback
+        self._queue = queue.Queue()
+        with db._lock:
+            documents = db._documents(collection)
+            self._notify([(DocumentReference(db, collection, document_id), ChangeType.ADDED) for document_id in sorted(documents)], db._now())
+            db._watches.append(self)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # Called with the database lock held, so the snapshot matches the changes
+    def _notify(self, changed, read_time):
+        if not changed:
+            return
+        documents = self._db._documents(self._collection)
+        snapshots = [DocumentSnapshot(DocumentReference(self._db, self._collection, document_id), *documents[document_id]) for document_id in sorted(documents)]
+        changes = [
+            DocumentChange(change_type, DocumentSnapshot(reference, *documents.get(reference.id, (None, read_time))), -1, -1)
+            for reference, change_type in changed
+        ]
+        self._db.reads += len(changes)
+        self._queue.put((snapshots, changes, read_time))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._callback(*item)
+
+    def unsubscribe(self):
+        with self._db._lock:
+            if self in self._db._watches:
+                self._db._watches.remove(self)
+        self._queue.put(None)
+
+
+class WriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._operations = []
+
+    def set(self, reference, document_data, merge=False):
+        self._operations.append(('set', reference, document_data, {'merge': merge}))
+
+    def update(self, reference, field_updates):
+        self._operations.append(('update', reference, field_updates, {}))
+
+    def delete(self, reference):
+        self._operations.append(('delete', reference, {}, {}))
+
+    def commit(self):
+        operations, self._operations = self._operations, []
+        return self._db._apply(operations)
@@ -3,11 +3,41 @@
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from scipy import sparse
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import BallTree
+from sklearn.cluster import MiniBatchKMeans
+from google.api_core import exceptions as google_exceptions
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+import bisect
+import contextlib
+import cProfile
+import hashlib
+import json
+import multiprocessing
+import sys
+import tempfile
+import threading
+import time
 import os
 
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is not reported
+    resource = None
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where the shared state files are not locked
+    fcntl = None
+
 # Use an environment variable for the Firebase Admin SDK JSON file path.
 # Set the 'FIREBASE_ADMINSDK_JSON' environment variable to the path where your JSON file is located.
 # Example to set this in your environment:
@@ -16,163 +46,1391 @@ import os
 
 firebase_adminsdk_json_path = os.environ.get('FIREBASE_ADMINSDK_JSON', 'path/to/your/firebase-adminsdk.json')
 
-if not firebase_admin._apps:
-    cred = credentials.Certificate(firebase_adminsdk_json_path)
-    firebase_admin.initialize_app(cred)
-    
-db = firestore.client()
+# The client is created in main() and not at import time, so that worker processes
+# (and anything else importing this module) do not connect to Firebase.
+def get_database():
+    if not firebase_admin._apps:
+        cred = credentials.Certificate(firebase_adminsdk_json_path)
+        firebase_admin.initialize_app(cred)
+
+    return firestore.client()
+
+# Settings for the batched homeEvents write stage.
+# A Firestore batch holds at most 500 writes.
+WRITE_BATCH_SIZE = min(int(os.environ.get('HOME_EVENTS_BATCH_SIZE', '500')), 500)
+WRITE_MAX_WORKERS = int(os.environ.get('HOME_EVENTS_WRITE_WORKERS', '8'))
+WRITE_MAX_RETRIES = int(os.environ.get('HOME_EVENTS_WRITE_RETRIES', '5'))
+
+RETRYABLE_WRITE_ERRORS = (
+    google_exceptions.Aborted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests,
+)
+
+# Weight of every interaction list in the users x events interaction matrix.
+INTERACTION_WEIGHTS = {
+    'likedEvents': 1,
+    'bookmarkedEvents': 1,
+    'myEvents': 1,
+    'dislikedEvents': -1,
+}
+
+# Every interaction counts as "seen", so nothing cancels out.
+SEEN_WEIGHTS = {col: 1 for col in INTERACTION_WEIGHTS}
+
+# Recommendation engine: 'per_user' trains one Logistic Regression Model per user,
+# 'als' fits a single matrix factorization of the interaction matrix for all users,
+# 'content' ranks the events by cosine similarity to a profile built from the user's events.
+RECOMMENDATION_ENGINE = os.environ.get('RECOMMENDATION_ENGINE', 'per_user')
+ALS_FACTORS = int(os.environ.get('ALS_FACTORS', '32'))
+ALS_REGULARIZATION = float(os.environ.get('ALS_REGULARIZATION', '0.1'))
+ALS_ITERATIONS = int(os.environ.get('ALS_ITERATIONS', '15'))
+
+# Approximate nearest neighbours for the 'content' engine on big catalogues.
+# With CONTENT_ANN_LISTS above 0 the events are clustered into that many lists, and every user
+# is only scored against the events of the CONTENT_ANN_PROBES lists closest to their profile.
+CONTENT_ANN_LISTS = int(os.environ.get('CONTENT_ANN_LISTS', '0'))
+CONTENT_ANN_PROBES = int(os.environ.get('CONTENT_ANN_PROBES', '4'))
+
+# Process pool for the 'per_user' engine. With a single worker the users are trained serially.
+PER_USER_WORKERS = int(os.environ.get('PER_USER_WORKERS', '1'))
+PER_USER_CHUNK_SIZE = int(os.environ.get('PER_USER_CHUNK_SIZE', '256'))
+
+# 'full' recomputes every user, 'incremental' only the users whose interactions changed
+# (or everyone with interactions when the events changed) since the last run.
+# A full run is the forced rebuild: it rewrites everything and resets the saved state.
+RUN_MODE = os.environ.get('RECOMMENDATION_RUN_MODE', 'full')
+RUN_STATE_PATH = os.environ.get('RECOMMENDATION_STATE_PATH', os.path.join('.recommendation_state', 'run_state.json'))
+
+# Sharded runs: with RECOMMENDATION_SHARD_COUNT above 1, this process only recomputes the users
+# whose id hashes to RECOMMENDATION_SHARD_INDEX, so N machines can split a refresh. Every shard
+# keeps its own run state, checkpoint and metrics, with the shard in the file name.
+SHARD_INDEX = int(os.environ.get('RECOMMENDATION_SHARD_INDEX', '0'))
+SHARD_COUNT = int(os.environ.get('RECOMMENDATION_SHARD_COUNT', '1'))
+# The finished users are checkpointed every CHECKPOINT_USERS users. A run that stops halfway
+# resumes from its checkpoint, and the checkpoint is removed once the run completes.
+CHECKPOINT_USERS = int(os.environ.get('RECOMMENDATION_CHECKPOINT_USERS', '5000'))
+CHECKPOINT_PATH = os.environ.get('RECOMMENDATION_CHECKPOINT_PATH', os.path.join('.recommendation_state', 'checkpoint.json'))
+
+# Length of every user's 'homeEvents' list. With HOME_EVENTS_STORE_SCORES=1 the scores of the
+# ranked events are stored next to it, in 'homeEventScores'.
+HOME_EVENTS_LIMIT = int(os.environ.get('HOME_EVENTS_LIMIT', '20'))
+STORE_HOME_EVENT_SCORES = os.environ.get('HOME_EVENTS_STORE_SCORES', '0') == '1'
+
+# Number of users scored together in one users x events block.
+SCORE_BLOCK_SIZE = int(os.environ.get('SCORE_BLOCK_SIZE', '1024'))
+
+# Memory-lean mode: the interaction lists of the users are interned into int32 event positions.
+MEMORY_LEAN = os.environ.get('RECOMMENDATION_MEMORY_LEAN', '0') == '1'
+# Memory budget of one users x events score block, in MiB. Above 0 the users are scored in blocks
+# small enough to fit it (never more than SCORE_BLOCK_SIZE, or PER_USER_CHUNK_SIZE per worker).
+MEMORY_BUDGET_MIB = float(os.environ.get('RECOMMENDATION_MEMORY_BUDGET_MIB', '0'))
+# Bytes held for every scored (user, event) pair: the float32 score, its negated copy for the
+# ranking and the int64 position returned by argpartition
+SCORE_BYTES_PER_PAIR = 16
+
+# Persistent feature store of the encoded events.
+FEATURE_STORE_DIR = os.environ.get('FEATURE_STORE_DIR', os.path.join('.recommendation_state', 'features'))
+
+# Number of documents requested per page when fetching a collection.
+FETCH_PAGE_SIZE = int(os.environ.get('FETCH_PAGE_SIZE', '1000'))
+
+# Local snapshots of the events and Users collections.
+# 'off' reads the collections from Firestore, 'sync' delta-syncs the snapshots and loads them,
+# 'offline' loads the snapshots as they are without connecting to Firebase at all, and writes the
+# recommendations to HOME_EVENTS_OUTPUT_PATH instead of 'homeEvents'.
+SNAPSHOT_MODE = os.environ.get('RECOMMENDATION_SNAPSHOT_MODE', 'off')
+SNAPSHOT_DIR = os.environ.get('RECOMMENDATION_SNAPSHOT_DIR', os.path.join('.recommendation_state', 'snapshots'))
+# One JSON line per recomputed user ({"id", "homeEvents"[, "homeEventScores"]}). Full runs start a
+# new file and incremental runs append to it, so the last line of a user is their current list.
+HOME_EVENTS_OUTPUT_PATH = os.environ.get('RECOMMENDATION_HOME_EVENTS_OUTPUT_PATH', os.path.join('.recommendation_state', 'home_events.jsonl'))
+SNAPSHOT_GET_ALL_SIZE = 300
+
+# Catalogue pre-filter: only events that have not started yet and still have tickets left are
+# scored and recommended. Events without a date or an availability are kept.
+PREFILTER_EVENTS = os.environ.get('RECOMMENDATION_PREFILTER_EVENTS', '1') == '1'
+
+# Geospatial candidate pruning.
+# With CANDIDATE_RADIUS_KM above 0, users are only scored against the events within that distance
+# of an event they interacted with. Users left with fewer than CANDIDATE_MIN_COUNT new candidates
+# (or without any located interaction) are scored against every event.
+CANDIDATE_RADIUS_KM = float(os.environ.get('CANDIDATE_RADIUS_KM', '0'))
+CANDIDATE_MIN_COUNT = int(os.environ.get('CANDIDATE_MIN_COUNT', str(HOME_EVENTS_LIMIT)))
+EARTH_RADIUS_KM = 6371.0
+# Above this fraction of candidate (user, event) pairs the 'als' engine scores the block densely
+CANDIDATE_DENSE_FRACTION = 0.1
+
+# Run metrics, written as a JSON report at the end of every run.
+# 'basic' records the time and peak memory of every stage and the Firestore read and write counts.
+# 'detailed' also records histograms of the per-user train and predict latencies.
+METRICS_LEVEL = os.environ.get('RECOMMENDATION_METRICS', 'basic')
+METRICS_PATH = os.environ.get('RECOMMENDATION_METRICS_PATH', os.path.join('.recommendation_state', 'metrics.json'))
+# Set to a file path to write a cProfile dump of the whole run (read it with python -m pstats).
+# For a sampling profile of a running job, attach an external sampler such as py-spy instead.
+PROFILE_PATH = os.environ.get('RECOMMENDATION_PROFILE_PATH', '')
+# Interval of the memory samples taken while a stage runs, for its own peak RSS
+RSS_SAMPLE_SECONDS = 0.01
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# The only fields fetched from each collection (and kept in the snapshots).
+# Long texts such as 'description', 'overview' and 'imageURL' are never downloaded.
+# The few distinct categories and cities are dictionary-encoded, so they load as categoricals
+# straight from Arrow instead of one Python string per event.
+COLLECTION_SCHEMAS = {
+    'events': pa.schema([
+        ('eventID', pa.string()),
+        ('category', pa.dictionary(pa.int32(), pa.string())),
+        ('city', pa.dictionary(pa.int32(), pa.string())),
+        ('price', pa.string()),
+        ('date', pa.timestamp('us', tz='UTC')),
+        ('availability', pa.int64()),
+        ('geohash', pa.string()),
+        ('latitude', pa.float64()),
+        ('longitude', pa.float64()),
+    ]),
+    'Users': pa.schema([(col, pa.list_(pa.string())) for col in INTERACTION_WEIGHTS]),
+}
+
+#Run metrics
+def peak_rss_mib(who='self'):
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+#Current RSS, read from /proc (None where it is not available)
+def current_rss_mib():
+    try:
+        with open('/proc/self/statm') as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+    except OSError:
+        return None
+    return round(resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+
+#High-water mark of the RSS over a with block. ru_maxrss only holds the peak of the whole
+#process, so the RSS is sampled on a background thread every interval seconds. When the process
+#peak rises during the block, that new peak is the block's own peak, so it is used too.
+class RSSSampler:
+    def __init__(self, interval=RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.peak = None
+
+    def __enter__(self):
+        self.process_peak_before = peak_rss_mib()
+        self.peak = current_rss_mib()
+        if self.peak is not None:
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self._update(current_rss_mib())
+        process_peak = peak_rss_mib()
+        if process_peak is not None and process_peak > self.process_peak_before:
+            self._update(process_peak)
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            self._update(current_rss_mib())
+
+    def _update(self, rss):
+        if rss is not None:
+            self.peak = rss if self.peak is None else max(self.peak, rss)
+
+#Stages, counters and histograms of one run. Counters may be updated from the write threads.
+class RunMetrics:
+    def __init__(self, level=METRICS_LEVEL):
+        self.level = level
+        self.started = time.time()
+        self.stages = []
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        sampler = RSSSampler()
+        try:
+            with sampler:
+                yield
+        finally:
+            seconds = time.perf_counter() - start
+            stage = {'name': name, 'seconds': round(seconds, 3), 'peak_rss_mib': sampler.peak, 'process_peak_rss_mib': peak_rss_mib()}
+            if peak_rss_mib('children'):
+                stage['peak_worker_rss_mib'] = peak_rss_mib('children')
+            self.stages.append(stage)
+            print(f"Stage '{name}': {seconds:.2f}s, peak RSS {stage['peak_rss_mib']} MiB (process peak {stage['process_peak_rss_mib']} MiB)")
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        if self.level != 'detailed':
+            return
+        milliseconds = seconds * 1000
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {
+                'buckets_ms': LATENCY_BUCKETS_MS,
+                'counts': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+                'count': 0,
+                'sum_ms': 0.0,
+                'max_ms': 0.0,
+            })
+            histogram['counts'][bisect.bisect_left(LATENCY_BUCKETS_MS, milliseconds)] += 1
+            histogram['count'] += 1
+            histogram['sum_ms'] += milliseconds
+            histogram['max_ms'] = max(histogram['max_ms'], milliseconds)
+
+    def report(self, **run_info):
+        return {
+            **run_info,
+            'level': self.level,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+            'total_seconds': round(time.time() - self.started, 3),
+            'peak_rss_mib': peak_rss_mib(),
+            'stages': self.stages,
+            'counters': self.counters,
+            'histograms': self.histograms,
+        }
+
+    def save(self, path=METRICS_PATH, **run_info):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        written_path = temp_path(path)
+        with open(written_path, 'w') as report_file:
+            json.dump(self.report(**run_info), report_file, indent=2)
+        os.replace(written_path, path)
+        print(f"Run metrics written to {path}")
+
+metrics = RunMetrics()
 
 #Fetching events and users from database
-def fetch_events_to_dataframe():
-    events_ref = db.collection('events')
-    events = events_ref.stream()
+#Only the fields of COLLECTION_SCHEMAS are requested, page by page in document id order.
+#Every page is turned into a columnar Arrow table right away, so at most one page of
+#documents is held as Python dicts at a time.
+def fetch_collection_pages(db, collection, page_size=FETCH_PAGE_SIZE):
+    query = (
+        db.collection(collection)
+        .select(COLLECTION_SCHEMAS[collection].names)
+        .order_by(FieldPath.document_id())
+        .limit(page_size)
+    )
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        docs = list(page_query.stream())
+        # A query is billed at least one read, even when it returns nothing
+        metrics.count('firestore_reads', max(len(docs), 1))
+        if docs:
+            yield docs
+        if len(docs) < page_size:
+            return
+        last_doc = docs[-1]
+
+def _document_records(documents, fields):
+    records = []
+    for doc in documents:
+        if not doc.exists:
+            continue
+        data = doc.to_dict()
+        record = {field: data.get(field) for field in fields}
+        record['id'] = doc.id
+        record['updateTime'] = doc.update_time.timestamp()
+        records.append(record)
+    return records
+
+#Approximate size on the wire, following the Firestore storage size rules
+def estimate_value_size(value):
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode()) + 1
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_value_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(len(key.encode()) + 1 + estimate_value_size(item) for key, item in value.items())
+    return 8
 
-    events_list = []
+def _records_to_table(records_df, schema):
+    schema = schema.append(pa.field('id', pa.string())).append(pa.field('updateTime', pa.float64()))
+    # Without rows the reindexed list columns stay float64, which Arrow cannot convert to lists
+    if records_df.empty:
+        return schema.empty_table()
+    records_df = records_df.reindex(columns=schema.names)
 
-    for event in events:
-        event_dict = event.to_dict()
-        event_dict['id'] = event.id
-        events_list.append(event_dict)
+    for field in schema:
+        values = records_df[field.name]
+        if pa.types.is_list(field.type):
+            records_df[field.name] = values.map(lambda x: [str(v) for v in x] if isinstance(x, list) else [])
+        elif pa.types.is_string(field.type) or pa.types.is_dictionary(field.type):
+            records_df[field.name] = values.astype(object).where(values.notna(), None).map(lambda x: x if x is None else str(x))
+        elif pa.types.is_timestamp(field.type):
+            records_df[field.name] = pd.to_datetime(values, errors='coerce', utc=True)
+        elif pa.types.is_integer(field.type):
+            records_df[field.name] = pd.to_numeric(values, errors='coerce').astype('Int64')
+        else:
+            records_df[field.name] = pd.to_numeric(values, errors='coerce')
+
+    return pa.Table.from_pandas(records_df, schema=schema, preserve_index=False)
+
+def _table_to_dataframe(table, collection):
+    df = table.to_pandas()
+    for field in COLLECTION_SCHEMAS[collection]:
+        if pa.types.is_list(field.type):
+            df[field.name] = df[field.name].map(list)
+    return df
+
+def fetch_collection_to_dataframe(db, collection, page_size=FETCH_PAGE_SIZE):
+    fields = COLLECTION_SCHEMAS[collection].names
+    tables = []
+    documents = 0
+    fetched_bytes = 0
+
+    for docs in fetch_collection_pages(db, collection, page_size):
+        records = _document_records(docs, fields)
+        documents += len(records)
+        fetched_bytes += sum(estimate_value_size(record) + 32 for record in records)
+        tables.append(_records_to_table(pd.DataFrame(records), COLLECTION_SCHEMAS[collection]))
+        del docs, records
+
+    if tables:
+        table = pa.concat_tables(tables)
+    else:
+        table = _records_to_table(pd.DataFrame(), COLLECTION_SCHEMAS[collection])
+
+    print(f"Fetched '{collection}': {documents} documents, {fetched_bytes / 1024:.1f} KiB in {len(tables)} pages")
+    return _table_to_dataframe(table, collection)
+
+def fetch_events_to_dataframe(db):
+    return fetch_collection_to_dataframe(db, 'events')
+
+def fetch_users_to_dataframe(db):
+    return fetch_collection_to_dataframe(db, 'Users')
 
-    events_df = pd.DataFrame(events_list)
-    return events_df
+#Files shared between processes
+#Shards on one host, the daemon and the query service share the feature store and the snapshots.
+#Every file is written to a temporary file of its own and moved into place, and read-modify-write
+#cycles hold an exclusive lock on a '.lock' file next to the state they change.
+def temp_path(path):
+    descriptor, path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(descriptor)
+    return path
+
+@contextlib.contextmanager
+def file_lock(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+#Local snapshots of the collections
+#Stored as uncompressed Arrow IPC files, so loading them is a memory map instead of a download
+def snapshot_path(collection, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, f'{collection}.arrow')
+
+#Held while a snapshot is synced or rewritten, so that concurrent syncs do not lose each other's changes
+def snapshot_lock(collection, snapshot_dir=SNAPSHOT_DIR):
+    return file_lock(snapshot_path(collection, snapshot_dir) + '.lock')
+
+def load_snapshot(collection, snapshot_dir=SNAPSHOT_DIR):
+    return _table_to_dataframe(feather.read_table(snapshot_path(collection, snapshot_dir), memory_map=True), collection)
+
+#The first sync fetches the whole collection. Later syncs list the document names and
+#update times only, and fetch just the documents that are new or changed.
+def sync_snapshot(db, collection, snapshot_dir=SNAPSHOT_DIR):
+    with snapshot_lock(collection, snapshot_dir):
+        fields = COLLECTION_SCHEMAS[collection].names
+        path = snapshot_path(collection, snapshot_dir)
+        collection_ref = db.collection(collection)
+
+        if os.path.exists(path):
+            snapshot_df = load_snapshot(collection, snapshot_dir)
+            stored_update_times = dict(zip(snapshot_df['id'], snapshot_df['updateTime']))
+            current_update_times = {
+                doc.id: doc.update_time.timestamp()
+                for doc in collection_ref.select([FieldPath.document_id()]).stream()
+            }
+            metrics.count('firestore_reads', max(len(current_update_times), 1))
+            changed_ids = [doc_id for doc_id, update_time in current_update_times.items() if stored_update_times.get(doc_id) != update_time]
+
+            changed_refs = [collection_ref.document(doc_id) for doc_id in changed_ids]
+            records = []
+            for start in range(0, len(changed_refs), SNAPSHOT_GET_ALL_SIZE):
+                chunk_refs = changed_refs[start:start + SNAPSHOT_GET_ALL_SIZE]
+                records.extend(_document_records(db.get_all(chunk_refs, field_paths=fields), fields))
+                metrics.count('firestore_reads', len(chunk_refs))
+
+            unchanged = snapshot_df['id'].isin(current_update_times.keys()) & ~snapshot_df['id'].isin(changed_ids)
+            fetched = len(records)
+            removed = len(stored_update_times.keys() - current_update_times.keys())
+            snapshot_df = pd.concat([snapshot_df[unchanged], pd.DataFrame(records)], ignore_index=True)
+        else:
+            snapshot_df = fetch_collection_to_dataframe(db, collection)
+            fetched = len(snapshot_df)
+            removed = 0
 
-def fetch_users_to_dataframe():
-    users_ref = db.collection('Users')
-    users = users_ref.stream()
+        write_snapshot(collection, snapshot_df, snapshot_dir)
+        print(f"Snapshot of '{collection}': {fetched} documents fetched, {removed} removed, {len(snapshot_df)} stored")
 
-    users_list = []
+#snapshot_df holds the COLLECTION_SCHEMAS fields with the 'id' and 'updateTime' of every document
+def write_snapshot(collection, snapshot_df, snapshot_dir=SNAPSHOT_DIR):
+    path = snapshot_path(collection, snapshot_dir)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    written_path = temp_path(path)
+    feather.write_feather(_records_to_table(snapshot_df, COLLECTION_SCHEMAS[collection]), written_path, compression='uncompressed')
+    os.replace(written_path, path)
 
-    for user in users:
-        user_dict = user.to_dict()
+#Writing the recommended events back to the database
+#Updates are grouped into batched commits that run on a small thread pool,
+#with at most 2 * max_workers batches in flight at any time
+class HomeEventsWriter:
+    def __init__(self, db, batch_size=WRITE_BATCH_SIZE, max_workers=WRITE_MAX_WORKERS, max_retries=WRITE_MAX_RETRIES):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.in_flight = threading.BoundedSemaphore(2 * max_workers)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.futures = []
+        self.stats = {'succeeded': 0, 'failed': 0, 'retried': 0}
+        self.failed_user_ids = []
 
-        user_ref = db.collection('Users').document(user.id)
-        user_ref.update({'homeEvents': []})
-        
-        user_dict['id'] = user.id  
-        users_list.append(user_dict)
+    def add(self, user_id, event_ids, scores=None):
+        update = {'homeEvents': list(event_ids)}
+        if scores is not None:
+            update['homeEventScores'] = list(scores)
+        self.pending.append((user_id, update))
+        if len(self.pending) >= self.batch_size:
+            self._submit()
 
-    users_df = pd.DataFrame(users_list)
-    return users_df
+    #Waits until every update added so far is committed (or has failed)
+    def flush(self):
+        if self.pending:
+            self._submit()
+        for future in self.futures:
+            future.result()
+        self.futures = []
 
-events_df = fetch_events_to_dataframe()
-users_df = fetch_users_to_dataframe()
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+        print(f"homeEvents writes: {self.stats['succeeded']} succeeded, "
+              f"{self.stats['failed']} failed, {self.stats['retried']} retried")
+        return self.stats
 
+    def _submit(self):
+        updates, self.pending = self.pending, []
+        self.in_flight.acquire()
+        future = self.executor.submit(self._commit, updates)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+    def _count(self, key, updates):
+        with self.lock:
+            self.stats[key] += len(updates)
+            if key == 'failed':
+                self.failed_user_ids.extend(user_id for user_id, _ in updates)
+
+    def _commit(self, updates):
+        for attempt in range(self.max_retries + 1):
+            batch = self.db.batch()
+            for user_id, update in updates:
+                batch.update(self.db.collection('Users').document(user_id), update)
+            try:
+                batch.commit()
+            except RETRYABLE_WRITE_ERRORS as error:
+                if attempt == self.max_retries:
+                    print(f"Giving up on a batch of {len(updates)} users: {error}")
+                    break
+                self._count('retried', updates)
+                time.sleep(min(2 ** attempt * 0.5, 30))
+                continue
+            except google_exceptions.GoogleAPICallError as error:
+                # A batch is atomic, so one missing user fails the whole batch.
+                # Commit the users one by one to find out which ones are affected.
+                if len(updates) > 1:
+                    for update in updates:
+                        self._commit([update])
+                    return
+                print(f"Could not update homeEvents for user ID {updates[0][0]}: {error}")
+                break
+            self._count('succeeded', updates)
+            metrics.count('firestore_writes', len(updates))
+            return
+        self._count('failed', updates)
+
+#Offline counterpart of HomeEventsWriter: the updates are appended to a local JSON lines file
+#instead of being committed to Firestore, so a write never fails
+class LocalHomeEventsWriter:
+    def __init__(self, path=HOME_EVENTS_OUTPUT_PATH, append=False):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.output_file = open(path, 'a' if append else 'w')
+        self.stats = {'succeeded': 0, 'failed': 0, 'retried': 0}
+        self.failed_user_ids = []
+
+    def add(self, user_id, event_ids, scores=None):
+        update = {'id': user_id, 'homeEvents': list(event_ids)}
+        if scores is not None:
+            update['homeEventScores'] = list(scores)
+        self.output_file.write(json.dumps(update) + '\n')
+        self.stats['succeeded'] += 1
+
+    def flush(self):
+        self.output_file.flush()
+        os.fsync(self.output_file.fileno())
+
+    def close(self):
+        self.flush()
+        self.output_file.close()
+        print(f"homeEvents: {self.stats['succeeded']} users written to {self.path}")
+        return self.stats
 
 #Events data processing
-event_columns_to_keep = ['eventID', 'category', 'city', 'price']
+#The feature store keeps the encoded events on disk between runs: a float32 matrix that is
+#memory-mapped from FEATURE_STORE_DIR and a vocabulary with the one-hot columns and the row of
+#every event. New categories and cities are appended as new columns, so the layout of existing
+#columns never shifts, and only new or changed events are encoded. Column 0 holds the raw price,
+#which is min-max scaled over the events being read, so the range always follows the current
+#catalogue instead of every price ever seen.
+#Several processes can share a store: update() holds the store's lock and reloads the store from
+#disk first, so it always starts from the last update of any of them.
+class EventFeatureStore:
+    def __init__(self, store_dir=FEATURE_STORE_DIR):
+        self.store_dir = store_dir
+        self.features_path = os.path.join(store_dir, 'features.npy')
+        self.vocabulary_path = os.path.join(store_dir, 'vocabulary.json')
+        self.lock_path = os.path.join(store_dir, 'store.lock')
+        with file_lock(self.lock_path):
+            self._load()
+
+    def _load(self):
+        if os.path.exists(self.vocabulary_path):
+            with open(self.vocabulary_path) as vocabulary_file:
+                vocabulary = json.load(vocabulary_file)
+            self.features = np.load(self.features_path, mmap_mode='r+')
+        else:
+            vocabulary = {'columns': ['price'], 'rows': {}, 'n_rows': 0}
+            self.features = None
+
+        self.columns = vocabulary['columns']
+        self.column_index = {column: position for position, column in enumerate(self.columns)}
+        self.rows = vocabulary['rows']
+        self.n_rows = vocabulary['n_rows']
 
-filtered_events_df = events_df[event_columns_to_keep].copy()
+    def update(self, events_df):
+        with file_lock(self.lock_path):
+            self._load()
+            return self._update(events_df)
 
-filtered_events_df['price'] = pd.to_numeric(filtered_events_df['price'].replace('Free', 0.0), errors='coerce')
+    def _update(self, events_df):
+        events_df = events_df[events_df['eventID'].notna()].drop_duplicates('eventID', keep='last')
+        stored = events_df['eventID'].map(lambda event_id: self.rows.get(event_id, [None, None])[1])
+        changed = events_df[stored != events_df['updateTime']]
 
-filtered_events_df['price'].fillna(0.0, inplace=True)
+        categories = changed['category'].astype(object).dropna()
+        cities = changed['city'].astype(object).dropna()
+        for column in sorted(set('category_' + categories) | set('city_' + cities)):
+            if column not in self.column_index:
+                self.column_index[column] = len(self.columns)
+                self.columns.append(column)
 
-events_encoded = pd.get_dummies(filtered_events_df, columns=['category', 'city'])
+        for event_id in set(self.rows) - set(events_df['eventID']):
+            del self.rows[event_id]
+        if self.n_rows > 2 * len(self.rows) + 1024:
+            self._compact()
 
-scaler = MinMaxScaler()
+        new_events = [event_id for event_id in changed['eventID'] if event_id not in self.rows]
+        self._reserve(self.n_rows + len(new_events))
+        for event_id in new_events:
+            self.rows[event_id] = [self.n_rows, None]
+            self.n_rows += 1
 
-columns_to_scale = events_encoded.columns.difference(['eventID'])
+        if len(changed):
+            positions = np.array([self.rows[event_id][0] for event_id in changed['eventID']])
+            prices = pd.to_numeric(changed['price'].replace('Free', 0.0), errors='coerce').fillna(0.0).to_numpy(dtype=np.float32)
 
-events_encoded[columns_to_scale] = scaler.fit_transform(events_encoded[columns_to_scale])
+            encoded = np.zeros((len(changed), len(self.columns)), dtype=np.float32)
+            encoded[:, 0] = prices
+            for prefix in ('category', 'city'):
+                values = (prefix + '_' + changed[prefix].astype(object)).map(self.column_index)
+                known = values.notna().to_numpy()
+                encoded[np.flatnonzero(known), values[known].astype(int).to_numpy()] = 1
 
-events_encoded['eventID'] = filtered_events_df['eventID']
+            self.features[positions] = encoded
+            for event_id, update_time in zip(changed['eventID'], changed['updateTime']):
+                self.rows[event_id][1] = float(update_time)
 
-column_order = ['eventID'] + [col for col in events_encoded if col != 'eventID']
-events_encoded = events_encoded[column_order]
+        self._save()
+        print(f"Feature store: {len(changed)} events encoded, {len(self.rows)} events, {len(self.columns)} features")
+
+        event_ids = events_df['eventID'].to_numpy()
+        return event_ids, self.read(event_ids)
+
+    def read(self, event_ids):
+        event_features = np.array(self.features[[self.rows[event_id][0] for event_id in event_ids]], dtype=np.float32)
+        if len(event_features):
+            event_features[:, 0] = MinMaxScaler().fit_transform(event_features[:, :1]).ravel()
+        return event_features
+
+    def _reserve(self, n_rows):
+        shape = self.features.shape if self.features is not None else (0, 0)
+        if n_rows <= shape[0] and len(self.columns) <= shape[1]:
+            return
+        capacity = max(n_rows, 2 * shape[0], 1024) if n_rows > shape[0] else shape[0]
+        self._rewrite(np.arange(min(self.n_rows, shape[0])), capacity)
+
+    def _compact(self):
+        event_ids = list(self.rows)
+        kept_rows = np.array([self.rows[event_id][0] for event_id in event_ids], dtype=np.int64)
+        for position, event_id in enumerate(event_ids):
+            self.rows[event_id][0] = position
+        self.n_rows = len(event_ids)
+        self._rewrite(kept_rows, max(self.n_rows, 1024))
+
+    def _rewrite(self, kept_rows, capacity):
+        os.makedirs(self.store_dir, exist_ok=True)
+        written_path = temp_path(self.features_path)
+        resized = np.lib.format.open_memmap(written_path, mode='w+', dtype=np.float32, shape=(capacity, len(self.columns)))
+        if self.features is not None and len(kept_rows):
+            resized[:len(kept_rows), :self.features.shape[1]] = self.features[kept_rows]
+        resized.flush()
+        del resized
+        self.features = None
+        os.replace(written_path, self.features_path)
+        self.features = np.load(self.features_path, mmap_mode='r+')
+
+    def _save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        if self.features is not None:
+            self.features.flush()
+        written_path = temp_path(self.vocabulary_path)
+        with open(written_path, 'w') as vocabulary_file:
+            json.dump({'columns': self.columns, 'rows': self.rows, 'n_rows': self.n_rows}, vocabulary_file)
+        os.replace(written_path, self.vocabulary_path)
 
 
 #Users data processing
-user_columns_to_keep = ['id', 'likedEvents', 'dislikedEvents', 'bookmarkedEvents', 'myEvents']
+def filter_users(users_df):
+    user_columns_to_keep = ['id', 'likedEvents', 'dislikedEvents', 'bookmarkedEvents', 'myEvents']
 
-filtered_users_df = users_df[user_columns_to_keep].copy()
+    filtered_users_df = users_df.reindex(columns=user_columns_to_keep)
 
-for col in ['likedEvents', 'dislikedEvents', 'bookmarkedEvents', 'myEvents']:
-    filtered_users_df[col] = filtered_users_df[col].apply(lambda x: x if isinstance(x, list) else [])
+    for col in ['likedEvents', 'dislikedEvents', 'bookmarkedEvents', 'myEvents']:
+        filtered_users_df[col] = filtered_users_df[col].apply(lambda x: x if isinstance(x, (list, np.ndarray)) else [])
 
-filtered_users_df = filtered_users_df[
-    filtered_users_df['likedEvents'].str.len() +
-    filtered_users_df['dislikedEvents'].str.len() +
-    filtered_users_df['bookmarkedEvents'].str.len() +
-    filtered_users_df['myEvents'].str.len() > 0
-]
+    filtered_users_df = filtered_users_df[
+        filtered_users_df['likedEvents'].str.len() +
+        filtered_users_df['dislikedEvents'].str.len() +
+        filtered_users_df['bookmarkedEvents'].str.len() +
+        filtered_users_df['myEvents'].str.len() > 0
+    ]
+    return filtered_users_df
 
 
-interaction_data = []
+#Sparse users x events interaction matrix
+#Row i is the i-th user of filtered_users_df and column j is the j-th of the run's event ids.
+#Interactions with events outside the catalogue are dropped and net-zero entries are removed.
+#Interned users (see intern_interactions) already hold the event positions.
+def build_interaction_matrix(users_df, event_ids, weights=INTERACTION_WEIGHTS):
+    event_index = pd.Index(event_ids)
 
-for idx, row in filtered_users_df.iterrows():
-    user_events = {}
+    rows, cols, values = [], [], []
+    for col, weight in weights.items():
+        user_events = users_df[col].to_list()
+        if user_events and isinstance(user_events[0], np.ndarray):
+            lengths = np.fromiter(map(len, user_events), dtype=np.int64, count=len(user_events))
+            rows.append(np.repeat(np.arange(len(user_events)), lengths))
+            cols.append(np.concatenate(user_events))
+            values.append(np.full(lengths.sum(), weight, dtype=np.float32))
+            continue
 
-    for event_id in row['likedEvents'] if isinstance(row['likedEvents'], list) else []:
-        user_events[event_id] = user_events.get(event_id, 0) + 1
-    for event_id in row['bookmarkedEvents'] if isinstance(row['bookmarkedEvents'], list) else []:
-        user_events[event_id] = user_events.get(event_id, 0) + 1
-    for event_id in row['myEvents'] if isinstance(row['myEvents'], list) else []:
-        user_events[event_id] = user_events.get(event_id, 0) + 1
+        exploded = users_df[col].reset_index(drop=True).explode().dropna()
+        event_positions = event_index.get_indexer(exploded.to_numpy())
+        known = event_positions >= 0
+        rows.append(exploded.index.to_numpy()[known])
+        cols.append(event_positions[known])
+        values.append(np.full(known.sum(), weight, dtype=np.float32))
 
-    for event_id in row['dislikedEvents'] if isinstance(row['dislikedEvents'], list) else []:
-        user_events[event_id] = user_events.get(event_id, 0) - 1
+    matrix = sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(users_df), len(event_index)),
+        dtype=np.float32,
+    )
+    matrix.eliminate_zeros()
+    matrix.sort_indices()
+    return matrix
 
-    interaction_data.append(user_events)
 
-interaction_matrix = pd.DataFrame(interaction_data, index=filtered_users_df.index)
+#Memory-lean mode
+#Every interaction list becomes an int32 array of event positions in the run's catalogue, all of
+#them views into one buffer per list column, instead of a list of Python strings. Interactions
+#with events outside the catalogue are dropped. The fingerprints of the users must be taken before.
+#The positions are looked up on the exploded column, like build_interaction_matrix does.
+def intern_interactions(users_df, event_ids):
+    event_index = pd.Index(event_ids)
+    interned_df = users_df.copy()
+    for col in INTERACTION_WEIGHTS:
+        exploded = users_df[col].reset_index(drop=True).explode()
+        positions = event_index.get_indexer(exploded.to_numpy())
+        known = positions >= 0
+        known_counts = np.bincount(exploded.index.to_numpy()[known], minlength=len(users_df))
+        interned_df[col] = pd.Series(np.split(positions[known].astype(np.int32), np.cumsum(known_counts)[:-1]) if len(users_df) else [], index=users_df.index, dtype=object)
+    return interned_df
 
-interaction_matrix.fillna(0, inplace=True)
+#Users per score block, so that one users x events block stays within the memory budget
+def budget_block_size(n_events, block_size, budget_mib=MEMORY_BUDGET_MIB):
+    if budget_mib <= 0:
+        return block_size
+    return max(1, min(block_size, int(budget_mib * 1024 * 1024 // (max(n_events, 1) * SCORE_BYTES_PER_PAIR))))
 
-altered_users_df = filtered_users_df.join(interaction_matrix)
 
-altered_users_df.drop(['likedEvents', 'dislikedEvents', 'bookmarkedEvents', 'myEvents'], axis=1, inplace=True)
+#Catalogue pre-filter
+#One boolean mask over the run's event ids, built once per run: True for the events that can still
+#be recommended (upcoming and bookable)
+def live_event_mask(events_df, event_ids, now=None):
+    events_df = events_df.drop_duplicates('eventID', keep='last').set_index('eventID').reindex(event_ids)
+    now = pd.Timestamp.now(tz='UTC') if now is None else now
+    finished = (events_df['date'] < now).fillna(False)
+    sold_out = (events_df['availability'] <= 0).fillna(False)
+    return ~(finished | sold_out).to_numpy(dtype=bool)
 
+def _live_positions(live_events, n_events):
+    return np.arange(n_events) if live_events is None else np.flatnonzero(live_events)
 
-#Access the Firestore database
-#Train the Linear Regression Model for every user seperatelly
-#Store the reccomended events ids to each users 'homeEvents' list in the database
-db = firestore.client()
 
-user_event_predictions = pd.DataFrame(index=altered_users_df.index, columns=events_encoded['eventID'])
+#Geospatial candidates
+#A BallTree over the event coordinates (haversine distance). Events without coordinates, and
+#those at (0, 0) where the generator puts addresses it could not geocode, are candidates for everyone.
+class CandidateIndex:
+    def __init__(self, events_df, event_ids, radius_km=CANDIDATE_RADIUS_KM, min_count=CANDIDATE_MIN_COUNT):
+        events_df = events_df.drop_duplicates('eventID', keep='last').set_index('eventID').reindex(event_ids)
+        coordinates = events_df[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+        self.located = ~np.isnan(coordinates).any(axis=1) & (coordinates != 0).any(axis=1)
+        self.located_positions = np.flatnonzero(self.located)
+        self.unlocated_positions = np.flatnonzero(~self.located)
+        self.coordinates = np.radians(coordinates)
+        self.min_count = min_count
+        self.n_events = len(event_ids)
+
+        # One row of neighbors per located event, and a last row with the unlocated events,
+        # which are candidates for every user
+        neighbors = []
+        if len(self.located_positions):
+            tree = BallTree(self.coordinates[self.located], metric='haversine')
+            neighbors = tree.query_radius(self.coordinates[self.located], r=radius_km / EARTH_RADIUS_KM)
+        neighbor_counts = [len(positions) for positions in neighbors] + [len(self.unlocated_positions)]
+        self.neighbor_matrix = sparse.csr_matrix(
+            (
+                np.ones(sum(neighbor_counts), dtype=np.float32),
+                np.concatenate([self.located_positions[positions] for positions in neighbors] + [self.unlocated_positions]),
+                np.concatenate([[0], np.cumsum(neighbor_counts)]),
+            ),
+            shape=(len(self.located_positions) + 1, self.n_events),
+        )
+        self.neighbor_rows = np.full(self.n_events, -1)
+        self.neighbor_rows[self.located_positions] = np.arange(len(self.located_positions))
+        print(f"Candidate index: {len(self.located_positions)} located events, {len(self.unlocated_positions)} without a location, "
+              f"{self.neighbor_matrix.nnz - len(self.unlocated_positions)} neighbor pairs within {radius_km} km")
+
+    #Returns a users x events boolean mask of the candidates of the given rows of the interaction
+    #matrix, and which of those rows fall back to every event. Only the events a user interacted
+    #with positively are anchors: a disliked event does not pull its neighbors in.
+    def candidates(self, interaction_matrix, rows):
+        block = interaction_matrix[rows]
+        user_anchors = block.copy()
+        user_anchors.data = (user_anchors.data > 0).astype(np.float32)
+        user_anchors.eliminate_zeros()
+        anchors = np.unique(user_anchors.indices)
+        anchors = anchors[self.located[anchors]]
+        neighbor_matrix = self.neighbor_matrix[np.append(self.neighbor_rows[anchors], -1)]
 
-for user_index, user_preferences in altered_users_df.iterrows():
-    
-    user_doc_id = user_preferences['id']
+        user_anchors = user_anchors[:, anchors] if len(anchors) else sparse.csr_matrix((len(rows), 0), dtype=np.float32)
+        user_anchors = sparse.hstack([user_anchors, np.ones((len(rows), 1), dtype=np.float32)], format='csr')
 
-    events_encoded_copy = events_encoded.copy()
+        # The product holds every (user, event) pair once; only its structure is kept, since converting
+        # the counts with astype(bool) would sort the (unordered) indices of every row
+        counts = user_anchors @ neighbor_matrix
+        mask = sparse.csr_matrix((np.ones(counts.nnz, dtype=bool), counts.indices, counts.indptr), shape=counts.shape)
+        new_candidates = mask.getnnz(axis=1) - block.getnnz(axis=1)
+        fallback = (user_anchors.getnnz(axis=1) == 1) | (new_candidates < self.min_count)
+        metrics.count('candidate_fallback_users', int(fallback.sum()))
+        metrics.count('candidate_events', int(mask.getnnz(axis=1)[~fallback].sum()))
+        return mask, fallback
 
-    train_event_ids = user_preferences[user_preferences != 0].index.tolist()
-    train_data = events_encoded[events_encoded['eventID'].isin(train_event_ids)]
 
-    final_events = events_encoded_copy[~events_encoded_copy['eventID'].isin(train_event_ids)]
-    final_events_copy = final_events.copy()
+#Incremental runs
+#The state file keeps a fingerprint of the event ids with their update times, one of the live
+#event ids, and per user a fingerprint of their interactions and of the last written 'homeEvents'.
+#Changes are found by comparing fingerprints instead of update times against a watermark: a
+#paginated fetch is not one consistent read, so a document changed behind the pages already read
+#can be older than a later page and would be missed for good.
+def empty_run_state():
+    return {'events': None, 'live': None, 'users': {}, 'homeEvents': {}}
 
-    if not train_data.empty:
-        
-        X_train = train_data.drop('eventID', axis=1)
-        y_train = [user_preferences[event_id] for event_id in train_data['eventID']]
+def load_run_state(path=RUN_STATE_PATH):
+    if not os.path.exists(path):
+        return empty_run_state()
+    with open(path) as state_file:
+        return json.load(state_file)
 
-        model = LogisticRegression()
-        model.fit(X_train, y_train)
+def save_run_state(state, path=RUN_STATE_PATH):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    written_path = temp_path(path)
+    with open(written_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(written_path, path)
 
-        X_test = final_events_copy.drop('eventID', axis=1)
+def fingerprint(value):
+    return hashlib.blake2b(json.dumps(value).encode(), digest_size=8).hexdigest()
 
-        predictions = model.predict(X_test)
+def interaction_fingerprints(users_df):
+    interactions = users_df.reindex(columns=list(INTERACTION_WEIGHTS))
+    return pd.Series(
+        [fingerprint([sorted(x) if isinstance(x, list) else [] for x in row]) for row in interactions.itertuples(index=False)],
+        index=users_df.index,
+    )
 
-        # Convert predictions to binary
-        final_events_copy['show_to_user'] = [1 if x > 1.5 else 0 for x in predictions]
+def find_changed_users(users_df, user_fingerprints, state):
+    return user_fingerprints != users_df['id'].map(state['users'])
 
-        user_event_predictions.loc[user_index] = final_events_copy['show_to_user']
+def events_fingerprint(events_df):
+    return fingerprint(sorted(zip(events_df['id'], events_df['updateTime'].astype(float))))
 
-        recommended_event_ids = final_events_copy[final_events_copy['show_to_user'] == 1]['eventID'].tolist()
-        
-        disliked_event_ids = filtered_users_df.loc[user_index]['dislikedEvents']
-        final_recommended_event_ids = [event_id for event_id in recommended_event_ids if event_id not in disliked_event_ids]
+def events_changed(events_df, state):
+    return events_fingerprint(events_df) != state['events']
 
-        user_ref = db.collection('Users').document(user_doc_id)
-        doc = user_ref.get()
-        if doc.exists:
-            user_ref.update({'homeEvents': final_recommended_event_ids})
+#Sharded runs
+#Users are assigned to shards by a stable hash of their document id (the same on every machine
+#and in every run), and every shard's files get the shard in their name
+def user_shards(user_ids, shard_count=SHARD_COUNT):
+    return pd.util.hash_pandas_object(pd.Series(user_ids, dtype=object), index=False).to_numpy() % shard_count
+
+def shard_path(path, shard_index=SHARD_INDEX, shard_count=SHARD_COUNT):
+    if shard_count == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f'{root}.shard{shard_index}of{shard_count}{extension}'
+
+#A checkpoint holds the interaction and 'homeEvents' fingerprints of the users finished so far,
+#and is only used by a run over the same engine and events
+def load_checkpoint(run_key, path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint['run'] != run_key:
+        print(f"Ignoring the checkpoint in {path}: it was written by a run over other events or settings")
+        return None
+    return checkpoint
+
+
+#Ranking
+#Picks the k best events of every row of a users x events score block at once with argpartition,
+#best first. Excluded events carry a score of -inf, and only scores above min_score are kept.
+def rank_top_k(scores, k=HOME_EVENTS_LIMIT, min_score=-np.inf):
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)) for _ in range(len(scores))]
+
+    top_positions = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top_positions, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top_positions = np.take_along_axis(top_positions, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    keep = top_scores > min_score
+    return [(positions[kept], values[kept]) for positions, values, kept in zip(top_positions, top_scores, keep)]
+
+
+#Recommendation engines
+#Every engine yields (user id, ranked event ids, scores) for the users of filtered_users_df,
+#or only for the rows listed in user_rows when it is given. With live_events, only those events are
+#scored, and events a user already interacted with (or disliked) are never recommended.
+
+#'per_user': train a Logistic Regression Model for every user seperatelly
+#Events the model predicts above 1.5 (liked and bookmarked, or booked) are the candidates,
+#scored by the probability the model gives to those preferences. The other events score -inf.
+#Returns None with the reason when no model can be trained, and otherwise the scores with
+#the train and predict times in seconds. With candidate_positions only those events are scored.
+def score_user(X_all, train_positions, y_train, candidate_positions=None):
+    if len(train_positions) == 0:
+        return None, "No training data available", None
+    if len(np.unique(y_train)) < 2:
+        return None, "Not enough distinct preferences to train a model", None
+    if candidate_positions is not None and len(candidate_positions) == 0:
+        return np.full(len(X_all), -np.inf, dtype=np.float32), None, (0.0, 0.0)
+
+    start = time.perf_counter()
+    model = LogisticRegression()
+    model.fit(X_all[train_positions], y_train)
+    trained = time.perf_counter()
+
+    probabilities = model.predict_proba(X_all if candidate_positions is None else X_all[candidate_positions])
+    predictions = model.classes_[probabilities.argmax(axis=1)]
+    candidate_scores = probabilities[:, model.classes_ > 1.5].sum(axis=1).astype(np.float32)
+    candidate_scores[predictions <= 1.5] = -np.inf
+
+    if candidate_positions is None:
+        scores = candidate_scores
+    else:
+        scores = np.full(len(X_all), -np.inf, dtype=np.float32)
+        scores[candidate_positions] = candidate_scores
+    return scores, None, (trained - start, time.perf_counter() - trained)
+
+#Users are scored chunk by chunk, so every chunk is one score block for rank_top_k.
+#Chunk items are (row, train positions, preferences, excluded positions, candidate positions).
+def _rank_chunk(X_all, chunk, k):
+    scores = np.full((len(chunk), len(X_all)), -np.inf, dtype=np.float32)
+    outcomes = []
+    for block_row, (_, train_positions, y_train, excluded_positions, candidate_positions) in enumerate(chunk):
+        user_scores, skip_reason, timings = score_user(X_all, train_positions, y_train, candidate_positions)
+        outcomes.append((skip_reason, timings))
+        if user_scores is not None:
+            scores[block_row] = user_scores
+            scores[block_row, excluded_positions] = -np.inf
+
+    ranked = rank_top_k(scores, k)
+    return [(item[0], *ranked_user, *outcome) for item, ranked_user, outcome in zip(chunk, ranked, outcomes)]
+
+#Work units of the process pool: the encoded events are written once to a memory-mapped
+#.npy file that every worker opens read-only, so only the per-user rows travel with a chunk
+_worker_events = None
+
+def _init_per_user_worker(events_path):
+    global _worker_events
+    _worker_events = np.load(events_path, mmap_mode='r')
+
+def _rank_chunk_in_worker(chunk, k):
+    return _rank_chunk(_worker_events, chunk, k)
+
+def _per_user_chunks(interaction_matrix, seen_matrix, user_rows, chunk_size, candidate_index=None, live_events=None):
+    live_positions = None if live_events is None else np.flatnonzero(live_events)
+    for chunk_start in range(0, len(user_rows), chunk_size):
+        chunk_rows = user_rows[chunk_start:chunk_start + chunk_size]
+        if candidate_index is not None:
+            candidate_mask, fallback = candidate_index.candidates(interaction_matrix, chunk_rows)
+
+        chunk = []
+        for chunk_row, row in enumerate(chunk_rows):
+            train_positions, y_train = _user_row(interaction_matrix, row)
+            seen_positions, _ = _user_row(seen_matrix, row)
+            candidate_positions = live_positions
+            if candidate_index is not None and not fallback[chunk_row]:
+                candidate_positions, _ = _user_row(candidate_mask, chunk_row)
+                if live_events is not None:
+                    candidate_positions = candidate_positions[live_events[candidate_positions]]
+            chunk.append((row, train_positions, y_train, seen_positions, candidate_positions))
+        yield chunk
+
+def _user_row(matrix, row):
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    return matrix.indices[start:end], matrix.data[start:end]
+
+def _rank_in_process_pool(X_all, chunks, workers, k):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        events_path = os.path.join(tmp_dir, 'event_features.npy')
+        np.save(events_path, X_all)
+
+        # Workers are spawned rather than forked from a process that already runs the Firestore
+        # client and the writer threads, and at most 2 * workers chunks are queued at any time
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_per_user_worker, initargs=(events_path,)) as executor:
+            in_flight = set()
+            for chunk in chunks:
+                if len(in_flight) >= 2 * workers:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+                in_flight.add(executor.submit(_rank_chunk_in_worker, chunk, k))
+            for future in as_completed(in_flight):
+                yield from future.result()
+
+def recommend_per_user(users_df, event_ids, event_features, interaction_matrix, user_rows=None, workers=PER_USER_WORKERS, chunk_size=PER_USER_CHUNK_SIZE, k=HOME_EVENTS_LIMIT, candidate_index=None, live_events=None):
+    X_all = event_features
+    user_ids = users_df['id'].to_numpy()
+    seen_matrix = build_interaction_matrix(users_df, event_ids, weights=SEEN_WEIGHTS)
+    if user_rows is None:
+        user_rows = np.arange(len(user_ids))
+
+    chunks = _per_user_chunks(interaction_matrix, seen_matrix, user_rows, chunk_size, candidate_index, live_events)
+    if workers > 1:
+        results = _rank_in_process_pool(X_all, chunks, workers, k)
+    else:
+        results = (result for chunk in chunks for result in _rank_chunk(X_all, chunk, k))
+
+    for row, ranked_positions, ranked_scores, skip_reason, timings in results:
+        user_doc_id = user_ids[row]
+        if timings is not None:
+            metrics.observe('per_user_train', timings[0])
+            metrics.observe('per_user_predict', timings[1])
+        if skip_reason is not None:
+            print(f"{skip_reason} for user ID {user_doc_id}")
+            continue
+
+        yield user_doc_id, event_ids[ranked_positions].tolist(), ranked_scores.tolist()
+
+#'als': one matrix factorization of the interaction matrix shared by all users.
+#Both alternating steps are a single regularized least squares solve over all users (or events),
+#so the whole fit is a handful of matrix products.
+def fit_als(interaction_matrix, factors=ALS_FACTORS, regularization=ALS_REGULARIZATION, iterations=ALS_ITERATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    n_users, n_events = interaction_matrix.shape
+
+    user_factors = np.zeros((n_users, factors), dtype=np.float32)
+    event_factors = rng.normal(scale=0.01, size=(n_events, factors)).astype(np.float32)
+    penalty = regularization * np.eye(factors, dtype=np.float32)
+
+    for _ in range(iterations):
+        user_factors = np.linalg.solve(event_factors.T @ event_factors + penalty, (interaction_matrix @ event_factors).T).T
+        event_factors = np.linalg.solve(user_factors.T @ user_factors + penalty, (interaction_matrix.T @ user_factors).T).T
+
+    return user_factors.astype(np.float32), event_factors.astype(np.float32)
+
+#The model is always fitted on every user; user_rows only limits which users are scored.
+#Only the live_events columns are scored (every event without them), and with a candidate_index
+#only the candidate pairs of each block.
+def recommend_als(users_df, event_ids, event_features, interaction_matrix, user_rows=None, k=HOME_EVENTS_LIMIT, candidate_index=None, block_size=SCORE_BLOCK_SIZE, live_events=None):
+    start = time.perf_counter()
+    user_factors, event_factors = fit_als(interaction_matrix)
+    metrics.observe('als_fit', time.perf_counter() - start)
+    live_positions = _live_positions(live_events, len(event_ids))
+    event_factors = event_factors[live_positions]
+    seen_matrix = build_interaction_matrix(users_df, event_ids, weights=SEEN_WEIGHTS)[:, live_positions]
+    user_ids = users_df['id'].to_numpy()
+    if user_rows is None:
+        user_rows = np.arange(len(user_ids))
+
+    for block_start in range(0, len(user_rows), block_size):
+        block = user_rows[block_start:block_start + block_size]
+        start = time.perf_counter()
+        if candidate_index is None:
+            scores = user_factors[block] @ event_factors.T
+        else:
+            candidate_mask, fallback = candidate_index.candidates(interaction_matrix, block)
+            candidate_mask = candidate_mask[:, live_positions]
+            pruned_rows = np.flatnonzero(~fallback)
+            if candidate_mask[pruned_rows].nnz > CANDIDATE_DENSE_FRACTION * len(pruned_rows) * len(live_positions):
+                # Most events are candidates anyway, so a dense product is cheaper than gathering them
+                scores = user_factors[block] @ event_factors.T
+                scores[pruned_rows] = np.where(candidate_mask[pruned_rows].toarray(), scores[pruned_rows], -np.inf)
+            else:
+                scores = np.full((len(block), len(live_positions)), -np.inf, dtype=np.float32)
+                scores[fallback] = user_factors[block[fallback]] @ event_factors.T
+                for block_row in pruned_rows:
+                    candidate_positions, _ = _user_row(candidate_mask, block_row)
+                    scores[block_row, candidate_positions] = event_factors[candidate_positions] @ user_factors[block[block_row]]
+
+        # Events the user already interacted with (or disliked) are never recommended
+        seen_rows, seen_cols = seen_matrix[block].nonzero()
+        scores[seen_rows, seen_cols] = -np.inf
+        ranked = rank_top_k(scores, k, min_score=0)
+        metrics.observe('als_score_block', time.perf_counter() - start)
+
+        for user_doc_id, (ranked_positions, ranked_scores) in zip(user_ids[block], ranked):
+            yield user_doc_id, event_ids[live_positions[ranked_positions]].tolist(), ranked_scores.tolist()
+
+#'content': content-based nearest neighbours over the encoded events.
+#A user's profile is the sum of the vectors of their events, weighted like the interaction matrix
+#(disliked events count against it), so every profile of a block comes from one sparse product.
+#Events are ranked by cosine similarity to the profile, and only positive similarities are kept.
+def unit_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+#Inverted file index: the unit event vectors are clustered with k-means and stored list by list,
+#so the events of a list are one contiguous slice of the reordered vectors
+class ContentANNIndex:
+    def __init__(self, event_vectors, n_lists=CONTENT_ANN_LISTS, probes=CONTENT_ANN_PROBES, seed=0):
+        n_lists = max(1, min(n_lists, len(event_vectors)))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed, n_init=3).fit(event_vectors)
+        self.order = np.argsort(kmeans.labels_, kind='stable')
+        self.vectors = event_vectors[self.order]
+        self.bounds = np.searchsorted(kmeans.labels_[self.order], np.arange(n_lists + 1))
+        self.centroids = unit_rows(kmeans.cluster_centers_.astype(np.float32))
+        self.probes = min(probes, n_lists)
+        self.n_events = len(event_vectors)
+
+    #Ranks the k best events of every profile among the events of its closest lists, without a
+    #users x events block: each list is scored with one product over the profiles that probe it,
+    #and only its k best events per profile are kept for the final ranking.
+    #excluded holds the events never recommended to each row, and candidate_mask the only events
+    #allowed for the rows where restricted is set.
+    def rank(self, profiles, k, excluded, candidate_mask=None, restricted=None, min_score=-np.inf):
+        closest = np.argpartition(-(profiles @ self.centroids.T), self.probes - 1, axis=1)[:, :self.probes]
+        k = min(k, self.n_events)
+        kept_scores = np.full((len(profiles), self.probes, k), -np.inf, dtype=np.float32)
+        kept_positions = np.zeros((len(profiles), self.probes, k), dtype=np.int64)
+
+        for list_id in np.unique(closest):
+            block_rows, probes = np.nonzero(closest == list_id)
+            start, end = self.bounds[list_id], self.bounds[list_id + 1]
+            positions = self.order[start:end]
+            scores = profiles[block_rows] @ self.vectors[start:end].T
+            excluded_rows, excluded_cols = excluded[block_rows][:, positions].nonzero()
+            scores[excluded_rows, excluded_cols] = -np.inf
+            if candidate_mask is not None:
+                limited = np.flatnonzero(restricted[block_rows])
+                scores[limited] = np.where(candidate_mask[block_rows[limited]][:, positions].toarray(), scores[limited], -np.inf)
+
+            depth = min(k, end - start)
+            if depth == 0:
+                continue
+            top = np.argpartition(-scores, depth - 1, axis=1)[:, :depth]
+            kept_scores[block_rows, probes, :depth] = np.take_along_axis(scores, top, axis=1)
+            kept_positions[block_rows, probes, :depth] = positions[top]
+
+        kept_positions = kept_positions.reshape(len(profiles), -1)
+        ranked = rank_top_k(kept_scores.reshape(len(profiles), -1), k, min_score)
+        return [(row_positions[slots], values) for row_positions, (slots, values) in zip(kept_positions, ranked)]
+
+#The scored side of the engine: the positions and unit vectors of the live events, and their
+#ANN index with ann_lists above 0. Built once per catalogue, so callers that score users one
+#at a time (the query service) pass it to every call as content_index.
+def build_content_index(event_features, live_events=None, ann_lists=CONTENT_ANN_LISTS, ann_probes=CONTENT_ANN_PROBES):
+    live_positions = _live_positions(live_events, len(event_features))
+    event_vectors = unit_rows(np.asarray(event_features, dtype=np.float32)[live_positions])
+    ann_index = None
+    if ann_lists > 0 and len(event_vectors):
+        start = time.perf_counter()
+        ann_index = ContentANNIndex(event_vectors, ann_lists, ann_probes)
+        metrics.observe('content_ann_build', time.perf_counter() - start)
+    return live_positions, event_vectors, ann_index
+
+#Profiles are built from every event, but only the live_events are scored.
+def recommend_content(users_df, event_ids, event_features, interaction_matrix, user_rows=None, k=HOME_EVENTS_LIMIT, candidate_index=None, ann_lists=CONTENT_ANN_LISTS, ann_probes=CONTENT_ANN_PROBES, block_size=SCORE_BLOCK_SIZE, live_events=None, content_index=None):
+    event_features = np.asarray(event_features, dtype=np.float32)
+    if content_index is None:
+        content_index = build_content_index(event_features, live_events, ann_lists, ann_probes)
+    live_positions, event_vectors, ann_index = content_index
+    seen_matrix = build_interaction_matrix(users_df, event_ids, weights=SEEN_WEIGHTS)[:, live_positions]
+    user_ids = users_df['id'].to_numpy()
+    if user_rows is None:
+        user_rows = np.arange(len(user_ids))
+
+    for block_start in range(0, len(user_rows), block_size):
+        block = user_rows[block_start:block_start + block_size]
+        start = time.perf_counter()
+        profiles = unit_rows(np.asarray(interaction_matrix[block] @ event_features, dtype=np.float32))
+        candidate_mask = fallback = None
+        if candidate_index is not None:
+            candidate_mask, fallback = candidate_index.candidates(interaction_matrix, block)
+            candidate_mask = candidate_mask[:, live_positions]
+
+        if ann_index is not None:
+            ranked = ann_index.rank(profiles, k, seen_matrix[block], candidate_mask, None if fallback is None else ~fallback, min_score=0)
         else:
-            print(f"No document found for user ID {user_doc_id}")
+            scores = profiles @ event_vectors.T
+            if candidate_mask is not None:
+                pruned_rows = np.flatnonzero(~fallback)
+                scores[pruned_rows] = np.where(candidate_mask[pruned_rows].toarray(), scores[pruned_rows], -np.inf)
+            seen_rows, seen_cols = seen_matrix[block].nonzero()
+            scores[seen_rows, seen_cols] = -np.inf
+            ranked = rank_top_k(scores, k, min_score=0)
+        metrics.observe('content_score_block', time.perf_counter() - start)
+
+        for user_doc_id, (ranked_positions, ranked_scores) in zip(user_ids[block], ranked):
+            yield user_doc_id, event_ids[live_positions[ranked_positions]].tolist(), ranked_scores.tolist()
+
+RECOMMENDATION_ENGINES = {
+    'per_user': recommend_per_user,
+    'als': recommend_als,
+    'content': recommend_content,
+}
+
+
+#Store the reccomended events ids to each users 'homeEvents' list in the database
+#Scores the user_rows of filtered_users_df and queues their lists on the writer. Users of
+#affected_user_ids without recommendations get an empty list, and lists equal to the ones
+#written last time (per the run state) are skipped. Returns the fingerprints of all the lists.
+#With a checkpoint callback, it is called with the fingerprints every CHECKPOINT_USERS users.
+def recommend_and_write(writer, engine, filtered_users_df, event_ids, event_features, interaction_matrix, user_rows, affected_user_ids, state, candidate_index=None, live_events=None, checkpoint=None):
+    written_home_events = {}
+
+    def write_home_events(user_doc_id, recommended_event_ids, scores):
+        scores = [round(score, 4) for score in scores] if STORE_HOME_EVENT_SCORES else None
+        home_events_fingerprint = fingerprint([recommended_event_ids, scores])
+        written_home_events[user_doc_id] = home_events_fingerprint
+        if state['homeEvents'].get(user_doc_id) != home_events_fingerprint:
+            writer.add(user_doc_id, recommended_event_ids, scores)
+
+    engine_options = {'user_rows': user_rows, 'candidate_index': candidate_index, 'live_events': live_events}
+    if engine == 'per_user':
+        # Every worker holds the score block of one chunk at a time
+        engine_options['chunk_size'] = budget_block_size(len(event_ids), PER_USER_CHUNK_SIZE, MEMORY_BUDGET_MIB / max(PER_USER_WORKERS, 1))
     else:
-        print(f"No training data available for user ID {user_doc_id}")
+        n_scored = len(event_ids) if live_events is None else int(live_events.sum())
+        engine_options['block_size'] = budget_block_size(n_scored, SCORE_BLOCK_SIZE)
+
+    recommendations = RECOMMENDATION_ENGINES[engine](filtered_users_df, event_ids, event_features, interaction_matrix, **engine_options)
+    for processed, (user_doc_id, recommended_event_ids, scores) in enumerate(recommendations, 1):
+        write_home_events(user_doc_id, recommended_event_ids, scores)
+        print(f"Processed user {user_doc_id}")
+        if checkpoint is not None and processed % CHECKPOINT_USERS == 0:
+            checkpoint(written_home_events)
+
+    for user_doc_id in affected_user_ids:
+        if user_doc_id not in written_home_events:
+            write_home_events(user_doc_id, [], [])
+    return written_home_events
 
-    print(f"Processed user {user_doc_id}")
 
+def main():
+    if RECOMMENDATION_ENGINE not in RECOMMENDATION_ENGINES:
+        raise ValueError(f"Unknown RECOMMENDATION_ENGINE '{RECOMMENDATION_ENGINE}', expected one of {sorted(RECOMMENDATION_ENGINES)}")
+    if RUN_MODE not in ('full', 'incremental'):
+        raise ValueError(f"Unknown RECOMMENDATION_RUN_MODE '{RUN_MODE}', expected 'full' or 'incremental'")
+    if SNAPSHOT_MODE not in ('off', 'sync', 'offline'):
+        raise ValueError(f"Unknown RECOMMENDATION_SNAPSHOT_MODE '{SNAPSHOT_MODE}', expected 'off', 'sync' or 'offline'")
+    if METRICS_LEVEL not in ('basic', 'detailed'):
+        raise ValueError(f"Unknown RECOMMENDATION_METRICS '{METRICS_LEVEL}', expected 'basic' or 'detailed'")
+    if not 0 <= SHARD_INDEX < SHARD_COUNT:
+        raise ValueError(f"RECOMMENDATION_SHARD_INDEX must be between 0 and {SHARD_COUNT - 1}, got {SHARD_INDEX}")
+    state_path = shard_path(RUN_STATE_PATH)
+    checkpoint_path = shard_path(CHECKPOINT_PATH)
+
+    # Offline runs never connect to Firebase
+    db = None if SNAPSHOT_MODE == 'offline' else get_database()
+
+    if SNAPSHOT_MODE == 'off':
+        with metrics.stage('fetch'):
+            events_df = fetch_events_to_dataframe(db)
+            users_df = fetch_users_to_dataframe(db)
+    else:
+        if SNAPSHOT_MODE == 'sync':
+            with metrics.stage('snapshot sync'):
+                sync_snapshot(db, 'events')
+                sync_snapshot(db, 'Users')
+        with metrics.stage('snapshot load'):
+            events_df = load_snapshot('events')
+            users_df = load_snapshot('Users')
+    metrics.count('events', len(events_df))
+    metrics.count('users', len(users_df))
+
+    with metrics.stage('encode events'):
+        event_ids, event_features = EventFeatureStore().update(events_df)
+    with metrics.stage('build interactions'):
+        user_fingerprints = interaction_fingerprints(users_df)
+        if MEMORY_LEAN:
+            users_df = intern_interactions(users_df, event_ids)
+        filtered_users_df = filter_users(users_df)
+        interaction_matrix = build_interaction_matrix(filtered_users_df, event_ids)
+    live_events = live_fingerprint = None
+    if PREFILTER_EVENTS:
+        with metrics.stage('prefilter'):
+            live_events = live_event_mask(events_df, event_ids)
+            live_fingerprint = fingerprint(event_ids[live_events].tolist())
+        metrics.count('live_events', int(live_events.sum()))
+    candidate_index = None
+    if CANDIDATE_RADIUS_KM > 0:
+        with metrics.stage('spatial index'):
+            candidate_index = CandidateIndex(events_df, event_ids)
+
+    #Pick the users to recompute
+    with metrics.stage('select users'):
+        if RUN_MODE == 'incremental':
+            state = load_run_state(state_path)
+            affected = find_changed_users(users_df, user_fingerprints, state)
+            # Events that started or sold out since the last run leave the live set without any
+            # document change of their own
+            if events_changed(events_df, state) or state.get('live') != live_fingerprint:
+                affected |= users_df.index.isin(filtered_users_df.index)
+        else:
+            state = empty_run_state()
+            affected = pd.Series(True, index=users_df.index)
+        in_shard = user_shards(users_df['id']) == SHARD_INDEX
+        affected &= in_shard
+
+        # Users finished by a run that stopped halfway are skipped, unless they changed since
+        run_key = fingerprint([RECOMMENDATION_ENGINE, RUN_MODE, state['events'], state.get('live'), events_fingerprint(events_df), live_fingerprint])
+        finished = load_checkpoint(run_key, checkpoint_path) or {'run': run_key, 'users': {}, 'homeEvents': {}}
+        resumed = users_df['id'].map(finished['users']) == user_fingerprints
+        if resumed.any():
+            print(f"Resuming from {checkpoint_path}: {int((affected & resumed).sum())} users already finished")
+        affected &= ~resumed
+        state['homeEvents'].update(finished['homeEvents'])
+
+        affected_user_ids = set(users_df.loc[affected, 'id'])
+        user_rows = np.flatnonzero(filtered_users_df['id'].isin(affected_user_ids).to_numpy())
+    metrics.count('users_recomputed', len(affected_user_ids))
+    shard = f", shard {SHARD_INDEX} of {SHARD_COUNT}" if SHARD_COUNT > 1 else ""
+    print(f"Recomputing {len(affected_user_ids)} of {len(users_df)} users ({RUN_MODE} run{shard})")
+
+    if SNAPSHOT_MODE == 'offline':
+        # A resumed full run keeps the lines written before it stopped
+        writer = LocalHomeEventsWriter(shard_path(HOME_EVENTS_OUTPUT_PATH), append=RUN_MODE == 'incremental' or bool(finished['users']))
+    else:
+        writer = HomeEventsWriter(db)
+    fingerprints_by_id = dict(zip(users_df['id'], user_fingerprints))
+
+    def save_checkpoint(written_home_events):
+        writer.flush()
+        failed_user_ids = set(writer.failed_user_ids)
+        for user_doc_id, home_events in written_home_events.items():
+            if user_doc_id not in failed_user_ids:
+                finished['users'][user_doc_id] = fingerprints_by_id[user_doc_id]
+                finished['homeEvents'][user_doc_id] = home_events
+        save_run_state(finished, checkpoint_path)
+
+    with metrics.stage('recommend'):
+        written_home_events = recommend_and_write(
+            writer, RECOMMENDATION_ENGINE, filtered_users_df, event_ids, event_features, interaction_matrix,
+            user_rows, users_df.loc[affected, 'id'], state, candidate_index, live_events, save_checkpoint,
+        )
+
+    #Writes run in the background while users are scored; this is the wait for the last ones
+    with metrics.stage('write'):
+        write_stats = writer.close()
+    for key, value in write_stats.items():
+        metrics.count(f'home_events_{key}', value)
+
+    #Save the state for the next incremental run. Users whose write failed are left out,
+    #so that they are recomputed next time.
+    with metrics.stage('save state'):
+        state['events'] = events_fingerprint(events_df)
+        state['live'] = live_fingerprint
+        state['users'] = dict(zip(users_df.loc[in_shard, 'id'], user_fingerprints[in_shard]))
+        state['homeEvents'] = {user_doc_id: home_events for user_doc_id, home_events in {**state['homeEvents'], **written_home_events}.items() if user_doc_id in state['users']}
+        for user_doc_id in writer.failed_user_ids:
+            state['users'].pop(user_doc_id, None)
+            state['homeEvents'].pop(user_doc_id, None)
+        save_run_state(state, state_path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    metrics.save(
+        shard_path(METRICS_PATH),
+        engine=RECOMMENDATION_ENGINE,
+        run_mode=RUN_MODE,
+        snapshot_mode=SNAPSHOT_MODE,
+        shard=[SHARD_INDEX, SHARD_COUNT],
+        profile=PROFILE_PATH or None,
+    )
+
+
+if __name__ == '__main__':
+    if PROFILE_PATH:
+        profiler = cProfile.Profile()
+        profiler.runcall(main)
+        profiler.dump_stats(PROFILE_PATH)
+        print(f"Profile written to {PROFILE_PATH}")
+    else:
+        main()
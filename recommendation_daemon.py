@@ -0,0 +1,297 @@
+#run with python and not python3
+
+#Real-time recommendations.
+#The daemon keeps the encoded events and the interactions of every user in memory and listens to
+#the events and Users collections. When the interactions of a user change, that user is rescored and
+#their 'homeEvents' are rewritten within seconds: changes are collected until the collection has been
+#quiet for DEBOUNCE_SECONDS (or for at most MAX_DELAY_SECONDS), and every user changed in that window
+#is rescored once. The daemon's own 'homeEvents' writes leave the interactions as they are, so they
+#never trigger a rescore. A change to the events rescores every user, as in a batch run of
+#machine_learning.py, after the longer EVENTS_DEBOUNCE_SECONDS. So does a change of the live events
+#(upcoming and bookable): a sold out event arrives as an event change, and the daemon wakes up by
+#itself when the next live event starts.
+#
+#The local snapshots of both collections, the run state and the daemon's own metrics file are saved
+#every CHECKPOINT_SECONDS and on exit. The daemon starts warm from them when they exist: only the documents changed while it was
+#down are processed, and only the users whose interactions changed are rescored.
+#All the settings of machine_learning.py (engine, candidate radius, memory-lean mode...) apply.
+#
+#Examples:
+#python recommendation_daemon.py
+#RECOMMENDATION_ENGINE=content RECOMMENDATION_DAEMON_DEBOUNCE_SECONDS=0.5 python recommendation_daemon.py
+
+import functools
+import os
+import signal
+import threading
+import time
+
+from google.cloud.firestore_v1.watch import ChangeType
+import numpy as np
+import pandas as pd
+
+import machine_learning as ml
+
+DEBOUNCE_SECONDS = float(os.environ.get('RECOMMENDATION_DAEMON_DEBOUNCE_SECONDS', '2'))
+MAX_DELAY_SECONDS = float(os.environ.get('RECOMMENDATION_DAEMON_MAX_DELAY_SECONDS', '10'))
+EVENTS_DEBOUNCE_SECONDS = float(os.environ.get('RECOMMENDATION_DAEMON_EVENTS_DEBOUNCE_SECONDS', '30'))
+CHECKPOINT_SECONDS = float(os.environ.get('RECOMMENDATION_DAEMON_CHECKPOINT_SECONDS', '300'))
+# Kept apart from the metrics of the batch runs, which share the state directory
+DAEMON_METRICS_PATH = os.environ.get('RECOMMENDATION_DAEMON_METRICS_PATH', os.path.join('.recommendation_state', 'daemon_metrics.json'))
+
+COLLECTIONS = ('events', 'Users')
+
+
+class RecommendationDaemon:
+    def __init__(self, db, engine=ml.RECOMMENDATION_ENGINE, snapshot_dir=ml.SNAPSHOT_DIR, state_path=ml.RUN_STATE_PATH,
+                 store_dir=ml.FEATURE_STORE_DIR, metrics_path=DAEMON_METRICS_PATH, debounce_seconds=DEBOUNCE_SECONDS, max_delay_seconds=MAX_DELAY_SECONDS, events_debounce_seconds=EVENTS_DEBOUNCE_SECONDS):
+        self.db = db
+        self.engine = engine
+        self.snapshot_dir = snapshot_dir
+        self.state_path = state_path
+        self.metrics_path = metrics_path
+        self.debounce_seconds = {'Users': debounce_seconds, 'events': events_debounce_seconds}
+        self.max_delay_seconds = max_delay_seconds
+
+        # Per collection, document id -> record with the COLLECTION_SCHEMAS fields, 'id' and 'updateTime'.
+        # Records are replaced and never modified, so a copy of the dict is a consistent view.
+        self.records = {collection: {} for collection in COLLECTIONS}
+        self.pending = {collection: set() for collection in COLLECTIONS}
+        self.first_change = {}
+        self.last_change = {}
+        self.synced = set()
+        self.stopping = False
+        self.changed = threading.Condition()
+        self.watches = []
+
+        self.state = ml.empty_run_state()
+        self.feature_store = ml.EventFeatureStore(store_dir)
+        self.catalogue = None
+        self.events_df = None
+        self.live_until = None
+
+    def start(self):
+        warm = all(os.path.exists(ml.snapshot_path(collection, self.snapshot_dir)) for collection in COLLECTIONS)
+        if warm:
+            for collection in COLLECTIONS:
+                snapshot_df = ml.load_snapshot(collection, self.snapshot_dir)
+                self.records[collection] = {record['id']: record for record in snapshot_df.to_dict('records')}
+        if os.path.exists(self.state_path):
+            self.state = ml.load_run_state(self.state_path)
+        print(f"{'Warm' if warm else 'Cold'} start: {len(self.records['Users'])} users and {len(self.records['events'])} events loaded")
+
+        # The first round checks everything loaded against the run state
+        with self.changed:
+            for collection in COLLECTIONS:
+                self._mark(collection, self.records[collection].keys())
+        self.watches = [self.db.collection(collection).on_snapshot(functools.partial(self.on_snapshot, collection)) for collection in COLLECTIONS]
+
+    def stop(self):
+        with self.changed:
+            self.stopping = True
+            self.changed.notify_all()
+
+    #Listener callback, run on the listener's thread
+    def on_snapshot(self, collection, documents, changes, read_time):
+        fields = ml.COLLECTION_SCHEMAS[collection].names
+        ml.metrics.count('firestore_reads', len(changes))
+        with self.changed:
+            records = self.records[collection]
+            changed_ids = set()
+            if collection not in self.synced:
+                # Documents deleted while the daemon was down
+                removed = records.keys() - {document.id for document in documents}
+                for document_id in removed:
+                    del records[document_id]
+                changed_ids |= removed
+
+            for change in changes:
+                document_id = change.document.id
+                if change.type == ChangeType.REMOVED:
+                    if records.pop(document_id, None) is not None:
+                        changed_ids.add(document_id)
+                    continue
+                record = ml._document_records([change.document], fields)[0]
+                previous = records.get(document_id)
+                records[document_id] = record
+                if previous is not None and previous['updateTime'] == record['updateTime']:
+                    continue
+                # A user document also changes when its 'homeEvents' are written
+                if collection == 'Users' and previous is not None and all(_as_list(previous[field]) == _as_list(record[field]) for field in fields):
+                    continue
+                changed_ids.add(document_id)
+
+            self._mark(collection, changed_ids)
+            self.synced.add(collection)
+            self.changed.notify_all()
+
+    def _mark(self, collection, document_ids):
+        if not document_ids:
+            return
+        now = time.monotonic()
+        self.pending[collection] |= set(document_ids)
+        self.first_change.setdefault(collection, now)
+        self.last_change[collection] = now
+        self.changed.notify_all()
+
+    #Collections with pending changes that are due now, and when the next one is due otherwise
+    def _due(self, now):
+        due, wake_at = [], None
+        for collection in COLLECTIONS:
+            if not self.pending[collection]:
+                continue
+            debounce = self.debounce_seconds[collection]
+            due_at = min(self.last_change[collection] + debounce, self.first_change[collection] + max(debounce, self.max_delay_seconds))
+            if due_at <= now:
+                due.append(collection)
+            else:
+                wake_at = due_at if wake_at is None else min(wake_at, due_at)
+        return due, wake_at
+
+    def run(self, checkpoint_seconds=CHECKPOINT_SECONDS):
+        with self.changed:
+            while len(self.synced) < len(COLLECTIONS) and not self.stopping:
+                self.changed.wait()
+        if not self.stopping:
+            self.rescore(COLLECTIONS)
+
+        next_checkpoint = time.monotonic() + checkpoint_seconds
+        while True:
+            with self.changed:
+                while not self.stopping:
+                    now = time.monotonic()
+                    due, wake_at = self._due(now)
+                    started = self.live_until is not None and self.live_until <= now
+                    if due or started or now >= next_checkpoint:
+                        break
+                    self.changed.wait(min(t for t in (wake_at, self.live_until, next_checkpoint) if t is not None) - now)
+                if self.stopping:
+                    break
+            if due or started:
+                self.rescore(due)
+            if time.monotonic() >= next_checkpoint:
+                self.checkpoint()
+                next_checkpoint = time.monotonic() + checkpoint_seconds
+
+        for watch in self.watches:
+            watch.unsubscribe()
+        self.checkpoint()
+
+    def _frame(self, collection, records):
+        return ml._table_to_dataframe(ml._records_to_table(pd.DataFrame(records), ml.COLLECTION_SCHEMAS[collection]), collection)
+
+    def _refresh_catalogue(self, events_df):
+        event_ids, event_features = self.feature_store.update(events_df)
+        candidate_index = ml.CandidateIndex(events_df, event_ids) if ml.CANDIDATE_RADIUS_KM > 0 else None
+        self.catalogue = (event_ids, event_features, candidate_index)
+        self.events_df = events_df
+
+    #Copies the records of the pending users and of every event, and clears the pending changes
+    #of the collections of a round
+    def _take(self, collections):
+        with self.changed:
+            pending_users = self.pending['Users'] if 'Users' in collections else set()
+            user_records = [self.records['Users'][user_doc_id] for user_doc_id in pending_users if user_doc_id in self.records['Users']]
+            event_records = list(self.records['events'].values())
+            for collection in collections:
+                self.pending[collection] = set()
+                self.first_change.pop(collection, None)
+                self.last_change.pop(collection, None)
+        return user_records, event_records, pending_users
+
+    #Live events of the catalogue, and when the next one of them starts (on the monotonic clock)
+    def _live_events(self, event_ids):
+        now = pd.Timestamp.now(tz='UTC')
+        live_events = ml.live_event_mask(self.events_df, event_ids, now)
+        starts = self.events_df['date'][self.events_df['date'] > now]
+        self.live_until = time.monotonic() + (starts.min() - now).total_seconds() if len(starts) else None
+        return live_events
+
+    #One round: refreshes the catalogue when the events are due and rescores the changed users
+    #(every user when the events or the live events changed since the last round)
+    def rescore(self, collections):
+        start = time.perf_counter()
+        user_records, event_records, pending_users = self._take(collections)
+
+        rescore_everyone = False
+        if 'events' in collections or self.catalogue is None:
+            events_df = self._frame('events', event_records)
+            rescore_everyone = ml.events_changed(events_df, self.state)
+            self._refresh_catalogue(events_df)
+            self.state['events'] = ml.events_fingerprint(events_df)
+        event_ids, event_features, candidate_index = self.catalogue
+        live_events = None
+        if ml.PREFILTER_EVENTS:
+            live_events = self._live_events(event_ids)
+            live_fingerprint = ml.fingerprint(event_ids[live_events].tolist())
+            rescore_everyone = rescore_everyone or self.state.get('live') != live_fingerprint
+            self.state['live'] = live_fingerprint
+
+        # Only the changed users are framed, unless every user is rescored or the engine fits on every user
+        if rescore_everyone or self.engine == 'als':
+            with self.changed:
+                user_records = list(self.records['Users'].values())
+        users_df = self._frame('Users', user_records)
+        for user_doc_id in pending_users - set(users_df['id']):
+            self.state['users'].pop(user_doc_id, None)
+            self.state['homeEvents'].pop(user_doc_id, None)
+        candidates_df = users_df if rescore_everyone else users_df[users_df['id'].isin(pending_users)]
+        user_fingerprints = ml.interaction_fingerprints(candidates_df)
+        if not rescore_everyone:
+            candidates_df = candidates_df[user_fingerprints != candidates_df['id'].map(self.state['users'])]
+
+        if len(candidates_df):
+            # The factorization of the 'als' engine is fitted on every user; the other engines score users independently
+            scored_df = users_df if self.engine == 'als' else candidates_df
+            if ml.MEMORY_LEAN:
+                scored_df = ml.intern_interactions(scored_df, event_ids)
+            filtered_users_df = ml.filter_users(scored_df)
+            interaction_matrix = ml.build_interaction_matrix(filtered_users_df, event_ids)
+            user_rows = np.flatnonzero(filtered_users_df['id'].isin(set(candidates_df['id'])).to_numpy())
+
+            writer = ml.HomeEventsWriter(self.db)
+            written_home_events = ml.recommend_and_write(
+                writer, self.engine, filtered_users_df, event_ids, event_features, interaction_matrix,
+                user_rows, candidates_df['id'], self.state, candidate_index, live_events,
+            )
+            writer.close()
+            self.state['users'].update(zip(candidates_df['id'], user_fingerprints[candidates_df.index]))
+            self.state['homeEvents'].update(written_home_events)
+            for user_doc_id in writer.failed_user_ids:
+                self.state['users'].pop(user_doc_id, None)
+                self.state['homeEvents'].pop(user_doc_id, None)
+
+        seconds = time.perf_counter() - start
+        ml.metrics.count('daemon_users_rescored', len(candidates_df))
+        ml.metrics.observe('daemon_round', seconds)
+        print(f"Round ({', '.join(collections) or 'live events'}): {len(candidates_df)} users rescored in {seconds:.2f}s")
+
+    def checkpoint(self):
+        with self.changed:
+            records = {collection: list(self.records[collection].values()) for collection in COLLECTIONS}
+        for collection in COLLECTIONS:
+            with ml.snapshot_lock(collection, self.snapshot_dir):
+                ml.write_snapshot(collection, pd.DataFrame(records[collection]), self.snapshot_dir)
+        ml.save_run_state(self.state, self.state_path)
+        ml.metrics.save(self.metrics_path, engine=self.engine, run_mode='daemon')
+        print(f"Checkpoint: {len(records['Users'])} users and {len(records['events'])} events saved")
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, np.ndarray)) else []
+
+
+def main():
+    if ml.RECOMMENDATION_ENGINE not in ml.RECOMMENDATION_ENGINES:
+        raise ValueError(f"Unknown RECOMMENDATION_ENGINE '{ml.RECOMMENDATION_ENGINE}', expected one of {sorted(ml.RECOMMENDATION_ENGINES)}")
+
+    daemon = RecommendationDaemon(ml.get_database())
+    # Ctrl+C and SIGTERM finish the current round and save a checkpoint
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    daemon.start()
+    daemon.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+#run with python and not python3
+
+#On-demand recommendations over HTTP/JSON.
+#GET /recommendations/<user id>?limit=N returns the ranked event ids of a user, computed on the fly
+#from the in-memory event features, so users that no batch run has seen yet (or whose interactions
+#changed a moment ago) get recommendations right away. Users the engine cannot rank (such as users
+#without any interaction) get the live events with the most positive interactions instead.
+#GET /health describes the service.
+#
+#The service listens to the events and Users collections like recommendation_daemon.py, but it never
+#writes 'homeEvents'. Results are kept in a bounded LRU cache with a TTL: the entry of a user is
+#dropped as soon as their interactions change, and the whole cache when the events (or the live
+#events) change. Only the engines that score every user on their own can answer a single user,
+#so 'als' is not available here.
+#
+#Examples:
+#python recommendation_service.py
+#curl http://127.0.0.1:8080/recommendations/<user id>?limit=10
+#RECOMMENDATION_SERVICE_ENGINE=per_user RECOMMENDATION_SERVICE_PORT=9000 python recommendation_service.py
+
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import signal
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+import machine_learning as ml
+from recommendation_daemon import RecommendationDaemon, _as_list
+
+SERVICE_HOST = os.environ.get('RECOMMENDATION_SERVICE_HOST', '127.0.0.1')
+SERVICE_PORT = int(os.environ.get('RECOMMENDATION_SERVICE_PORT', '8080'))
+SERVICE_ENGINE = os.environ.get('RECOMMENDATION_SERVICE_ENGINE', 'content')
+SERVICE_ENGINES = ('per_user', 'content')
+# Largest limit a request can ask for; results are computed for at least HOME_EVENTS_LIMIT events
+SERVICE_MAX_LIMIT = int(os.environ.get('RECOMMENDATION_SERVICE_MAX_LIMIT', '100'))
+
+# At most CACHE_MAX_ENTRIES users are cached, each for at most CACHE_TTL_SECONDS (0 disables the cache)
+CACHE_MAX_ENTRIES = int(os.environ.get('RECOMMENDATION_CACHE_MAX_ENTRIES', '100000'))
+CACHE_TTL_SECONDS = float(os.environ.get('RECOMMENDATION_CACHE_TTL_SECONDS', '300'))
+# The service's own metrics file, apart from those of the batch runs and the daemon
+SERVICE_METRICS_PATH = os.environ.get('RECOMMENDATION_SERVICE_METRICS_PATH', os.path.join('.recommendation_state', 'service_metrics.json'))
+
+
+#Bounded LRU of results: an entry expires ttl_seconds after it was stored, and the least
+#recently used entry is evicted when max_entries is reached
+class ResultCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                ml.metrics.count('service_cache_expired')
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0 or self.ttl_seconds <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                ml.metrics.count('service_cache_evicted')
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    ml.metrics.count('service_cache_invalidated')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+#The daemon's listeners and records, with its rounds reduced to refreshing the served catalogue
+class RecommendationService(RecommendationDaemon):
+    def __init__(self, db, engine=SERVICE_ENGINE, cache_max_entries=CACHE_MAX_ENTRIES, cache_ttl_seconds=CACHE_TTL_SECONDS, metrics_path=SERVICE_METRICS_PATH, **daemon_options):
+        super().__init__(db, engine, metrics_path=metrics_path, **daemon_options)
+        self.cache = ResultCache(cache_max_entries, cache_ttl_seconds)
+        self.served = None
+        self.ready = threading.Event()
+
+    #Changed users are dropped from the cache right away; event changes wait for a round
+    def _mark(self, collection, document_ids):
+        if collection == 'Users':
+            self.cache.invalidate(document_ids)
+        else:
+            super()._mark(collection, document_ids)
+
+    #One round: refreshes the catalogue when the events are due, and the live events every time
+    def rescore(self, collections):
+        start = time.perf_counter()
+        _, event_records, _ = self._take(collections)
+        if 'events' in collections or self.catalogue is None:
+            self._refresh_catalogue(self._frame('events', event_records))
+        event_ids, event_features, candidate_index = self.catalogue
+        live_events = self._live_events(event_ids) if ml.PREFILTER_EVENTS else None
+        content_index = ml.build_content_index(event_features, live_events) if self.engine == 'content' else None
+        # Built once here instead of by every request: the engines index the events with event_index,
+        # and a user's interactions are looked up in event_positions
+        event_index = pd.Index(event_ids)
+        event_positions = dict(zip(event_ids, range(len(event_ids))))
+        with self.changed:
+            user_records = list(self.records['Users'].values())
+        popular = _popular_events(user_records, event_index, live_events)
+
+        with self.changed:
+            self.served = (event_index, event_positions, event_features, candidate_index, live_events, content_index, popular)
+            self.cache.clear()
+        self.ready.set()
+        live = len(event_ids) if live_events is None else int(live_events.sum())
+        print(f"Catalogue ({', '.join(collections) or 'live events'}): {live} of {len(event_ids)} events served, refreshed in {time.perf_counter() - start:.2f}s")
+
+    #The service keeps no run state, so a checkpoint only saves the metrics
+    def checkpoint(self):
+        ml.metrics.save(self.metrics_path, engine=self.engine, run_mode='service')
+
+    #The (at least) k best event ids and scores of a user, and whether they came from the cache.
+    #Returns None for an unknown user. Users the listener has not delivered yet are read directly.
+    #A user's entry holds the k it was computed for, and only a request for more events recomputes it.
+    def recommend(self, user_doc_id, k=ml.HOME_EVENTS_LIMIT):
+        k = max(k, ml.HOME_EVENTS_LIMIT)
+        cached = self.cache.get(user_doc_id)
+        if cached is not None and cached[0] >= k:
+            ml.metrics.count('service_cache_hits')
+            return cached[1], True
+        ml.metrics.count('service_cache_misses')
+
+        with self.changed:
+            served = self.served
+            record = self.records['Users'].get(user_doc_id)
+        if record is None:
+            document = self.db.collection('Users').document(user_doc_id).get()
+            ml.metrics.count('firestore_reads')
+            if not document.exists:
+                return None
+            record = ml._document_records([document], ml.COLLECTION_SCHEMAS['Users'].names)[0]
+
+        event_index, event_positions, event_features, candidate_index, live_events, content_index, popular = served
+        users_df = _interned_user(record, event_positions)
+        result = {'eventIds': [], 'scores': [], 'coldStart': False}
+        if users_df is not None:
+            interaction_matrix = ml.build_interaction_matrix(users_df, event_index)
+            engine_options = {'content_index': content_index} if self.engine == 'content' else {'workers': 1}
+            for _, recommended_event_ids, scores in ml.RECOMMENDATION_ENGINES[self.engine](
+                    users_df, event_index, event_features, interaction_matrix, k=k,
+                    candidate_index=candidate_index, live_events=live_events, **engine_options):
+                result = {'eventIds': recommended_event_ids, 'scores': [round(score, 4) for score in scores], 'coldStart': False}
+        # Users without interactions, and users the engine cannot rank yet (the 'per_user' engine
+        # skips users who only liked or only disliked events), get the popular events they have not seen
+        if not result['eventIds']:
+            seen = {event_id for col in ml.INTERACTION_WEIGHTS for event_id in _as_list(record[col])}
+            popular_event_ids, interaction_counts = popular
+            ranked = [(event_id, count) for event_id, count in zip(popular_event_ids, interaction_counts) if event_id not in seen][:k]
+            result = {'eventIds': [event_id for event_id, _ in ranked], 'scores': [count for _, count in ranked], 'coldStart': True}
+
+        # A result computed while the user or the catalogue changed is returned but not cached,
+        # and neither is an empty one
+        with self.changed:
+            if result['eventIds'] and self.records['Users'].get(user_doc_id) is record and self.served is served:
+                self.cache.put(user_doc_id, (k, result))
+        return result, False
+
+    def health(self):
+        with self.changed:
+            users = len(self.records['Users'])
+            served = self.served
+        return {
+            'ready': served is not None,
+            'engine': self.engine,
+            'users': users,
+            'events': 0 if served is None else len(served[0]),
+            'liveEvents': None if served is None or served[4] is None else int(served[4].sum()),
+            'cachedUsers': len(self.cache),
+        }
+
+
+#Cold-start ranking of a catalogue: the live events by number of positive interactions (likes,
+#bookmarks and own events) over every user, as the event ids and counts of the first SERVICE_MAX_LIMIT
+def _popular_events(user_records, event_index, live_events, limit=SERVICE_MAX_LIMIT):
+    interaction_counts = np.zeros(len(event_index), dtype=np.int64)
+    for col, weight in ml.INTERACTION_WEIGHTS.items():
+        if weight <= 0:
+            continue
+        positions = event_index.get_indexer(pd.Series([record[col] for record in user_records], dtype=object).explode().dropna().to_numpy())
+        interaction_counts += np.bincount(positions[positions >= 0], minlength=len(event_index))
+    live_positions = ml._live_positions(live_events, len(event_index))
+    ranked = live_positions[np.argsort(-interaction_counts[live_positions], kind='stable')[:limit]]
+    return event_index[ranked].tolist(), interaction_counts[ranked].tolist()
+
+#One user as an interned users frame (see machine_learning.intern_interactions), built from the
+#event positions of the catalogue instead of through pandas, or None without interactions
+def _interned_user(record, event_positions):
+    interactions = {col: _as_list(record[col]) for col in ml.INTERACTION_WEIGHTS}
+    if not any(interactions.values()):
+        return None
+    user = {'id': [record['id']]}
+    for col, event_ids in interactions.items():
+        positions = [event_positions[event_id] for event_id in event_ids if event_id in event_positions]
+        user[col] = [np.array(positions, dtype=np.int32)]
+    return pd.DataFrame(user)
+
+
+class RecommendationRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        start = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        path = [urllib.parse.unquote(part) for part in url.path.strip('/').split('/')]
+        service = self.server.service
+
+        if path == ['health']:
+            self._send(200, service.health())
+        elif len(path) != 2 or path[0] != 'recommendations':
+            self._send(404, {'error': f'Unknown path {url.path}'})
+        elif not service.ready.is_set():
+            self._send(503, {'error': 'The catalogue is still loading'})
+        else:
+            limit = urllib.parse.parse_qs(url.query).get('limit', [str(ml.HOME_EVENTS_LIMIT)])[0]
+            if not limit.isdigit() or int(limit) > SERVICE_MAX_LIMIT:
+                self._send(400, {'error': f"limit must be an integer between 0 and {SERVICE_MAX_LIMIT}, got '{limit}'"})
+                return
+            limit = int(limit)
+            found = service.recommend(path[1], limit)
+            if found is None:
+                self._send(404, {'error': f"No user with ID '{path[1]}'"})
+            else:
+                result, cached = found
+                self._send(200, {'userId': path[1], 'eventIds': result['eventIds'][:limit], 'scores': result['scores'][:limit], 'coldStart': result['coldStart'], 'cached': cached})
+        ml.metrics.observe('service_request', time.perf_counter() - start)
+
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Requests are counted in the metrics instead of logged one by one
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(service, host=SERVICE_HOST, port=SERVICE_PORT):
+    server = ThreadingHTTPServer((host, port), RecommendationRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main():
+    if SERVICE_ENGINE not in SERVICE_ENGINES:
+        raise ValueError(f"Unknown RECOMMENDATION_SERVICE_ENGINE '{SERVICE_ENGINE}', expected one of {list(SERVICE_ENGINES)}")
+
+    service = RecommendationService(ml.get_database())
+    server = make_server(service)
+    # Ctrl+C and SIGTERM stop the listeners and the server and save the metrics
+    signal.signal(signal.SIGINT, lambda signum, frame: service.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: service.stop())
+    service.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving recommendations on http://{server.server_address[0]}:{server.server_address[1]}/recommendations/<user id>")
+    service.run()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
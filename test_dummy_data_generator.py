@@ -0,0 +1,194 @@
+#run with python -m pytest -q
+#Tests of the data generator against the in-memory Firestore. Nothing here reaches Firebase or the network.
+
+from datetime import date
+import hashlib
+import json
+from types import SimpleNamespace
+
+import firebase_admin.exceptions
+import pytest
+
+import dummy_data_generator as generator
+from in_memory_firestore import InMemoryFirestore
+import machine_learning as ml
+
+
+#Every test starts from the generator's import-time globals, inside tmp_path, with an offline geocoder
+#and an in-memory database
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = InMemoryFirestore()
+    monkeypatch.setattr(generator, 'db', db)
+    monkeypatch.setattr(generator, 'geocoder', generator.Geocoder(mode='offline'))
+    monkeypatch.setattr(generator, 'fixture_export', None)
+    monkeypatch.setattr(generator, 'reference_time', None)
+    monkeypatch.setattr(generator, 'event_prices', {})
+    return db
+
+
+#Auth users
+def import_result(batch, failed_indexes):
+    errors = [SimpleNamespace(index=index, reason='rejected') for index in failed_indexes]
+    return SimpleNamespace(success_count=len(batch) - len(errors), failure_count=len(errors), errors=errors)
+
+def test_auth_batches_return_the_failed_items(monkeypatch):
+    monkeypatch.setattr(generator, 'AUTH_BATCH_SIZE', 10)
+
+    def call(batch):
+        if batch[0] == 20:
+            raise firebase_admin.exceptions.UnavailableError('down')
+        return import_result(batch, [1, 4] if batch[0] == 0 else [])
+
+    failed = generator.run_auth_batches('import', call, list(range(35)))
+
+    assert sorted(failed) == [1, 4, *range(20, 30)]
+
+def test_imported_accounts_get_their_own_salt():
+    first = generator.import_user_record('uid1', 'first', generator.dummy_password)
+    second = generator.import_user_record('uid2', 'second', generator.dummy_password)
+
+    assert first.password_salt != second.password_salt and first.password_hash != second.password_hash
+    expected = hashlib.pbkdf2_hmac('sha256', generator.dummy_password.encode(), first.password_salt, generator.AUTH_PASSWORD_HASH_ROUNDS)
+    assert first.password_hash == expected
+
+def test_users_whose_account_failed_are_left_out(db, monkeypatch):
+    monkeypatch.setattr(generator, 'import_auth_users', lambda records: records[1:2])
+
+    user_ids, users = generator.create_dummy_users([('first', 'a'), ('second', 'b'), ('third', 'c')])
+
+    assert len(user_ids) == 2 and [user['username'] for user in users] == ['first', 'third']
+
+
+#Wiping the collections
+def fill(db, collection, count):
+    batch = db.batch()
+    for index in range(count):
+        batch.set(db.collection(collection).document(f'{collection}{index:04d}'), {'index': index})
+    batch.commit()
+
+def test_wipe_deletes_every_page_of_the_wiped_collections(db, monkeypatch):
+    monkeypatch.setattr(generator, 'FIRESTORE_BATCH_SIZE', 7)
+    for collection, count in [('Users', 30), ('events', 7), ('tickets', 0), ('savedEvents', 5)]:
+        fill(db, collection, count)
+
+    generator.wipe_collections(['Users', 'events', 'tickets'])
+
+    assert [len(db._documents(collection)) for collection in ['Users', 'events', 'tickets', 'savedEvents']] == [0, 0, 0, 5]
+
+def test_wipe_dry_run_only_counts(db, capsys):
+    fill(db, 'Users', 12)
+
+    generator.wipe_collections(['Users', 'events'], dry_run=True)
+
+    assert len(db._documents('Users')) == 12
+    assert capsys.readouterr().out.splitlines() == ["Would delete 12 documents from 'Users'", "Would delete 0 documents from 'events'"]
+
+
+#Scale mode
+def test_events_are_written_once_and_rotate_over_the_users(db):
+    user_ids = [f'user{index}' for index in range(5)]
+    users = [generator.dummy_user_document(f'name{index}') for index in range(5)]
+
+    all_event_ids, user_events = generator.create_events(user_ids, users, events_per_city=10)
+
+    cities = len(generator.cities_and_streets)
+    assert db.writes == 10 * cities
+    assert sorted(all_event_ids) == sorted(db._documents('events'))
+    assert len(db._documents('savedEvents')) == generator.GENERATOR_SAVED_EVENTS_PER_CITY * cities
+    for user_id, events in user_events.items():
+        assert events['publishedEvents'] and events['savedEvents']
+        assert all(db._documents('events')[event_id][0]['creatorId'] == user_id for event_id in events['publishedEvents'])
+    published = [event_id for events in user_events.values() for event_id in events['publishedEvents']]
+    assert sorted(published) == sorted(all_event_ids)
+
+def test_interactions_keep_their_proportions_at_any_count(db):
+    all_event_ids = [f'event{index}' for index in range(100)]
+    user_ids = ['user0', 'user1']
+    users = [generator.dummy_user_document('name0'), generator.dummy_user_document('name1')]
+    user_events = {user_id: {'publishedEvents': [], 'savedEvents': []} for user_id in user_ids}
+
+    user_attributes = generator.write_user_documents(user_ids, users, user_events, all_event_ids, interactions_per_user=72)
+
+    assert db.writes == 2
+    for user_id in user_ids:
+        stored = db._documents('Users')[user_id][0]
+        assert {col: len(stored[col]) for col in ['dislikedEvents', 'likedEvents', 'bookmarkedEvents', 'myEvents']} == \
+            {'dislikedEvents': 20, 'likedEvents': 48, 'bookmarkedEvents': 20, 'myEvents': 8}
+        assert stored['likedEvents'] == user_attributes[user_id]['likedEvents'] and stored['username'] == users[user_ids.index(user_id)]['username']
+
+
+#Tickets
+def test_tickets_read_every_booked_event_once(db, monkeypatch):
+    monkeypatch.setattr(generator, 'PRICE_PREFETCH_SIZE', 2)
+    prices = {'event0': '$10', 'event1': 'Free', 'event2': '€7.5', 'event3': '£20', 'event4': '$3'}
+    for event_id, price in prices.items():
+        db.collection('events').document(event_id).set({'price': price})
+    # Events created in the same run already have their price
+    generator.event_prices['event4'] = 3.0
+    user_ids = ['user0', 'user1']
+    users = [generator.dummy_user_document('name0'), generator.dummy_user_document('name1')]
+    user_attributes = {'user0': {'myEvents': ['event0', 'event1', 'missing']}, 'user1': {'myEvents': ['event0', 'event2', 'event3', 'event4']}}
+    reads = db.reads
+
+    generator.create_tickets(user_ids, users, user_attributes)
+
+    assert db.reads - reads == 5
+    tickets = [data for data, _ in db._documents('tickets').values()]
+    booked = {(ticket['userId'], ticket['eventId']) for ticket in tickets}
+    assert booked == {(user_id, event_id) for user_id in user_ids for event_id in user_attributes[user_id]['myEvents'] if event_id != 'missing'}
+    for ticket in tickets:
+        assert ticket['totalCost'] == round(generator.string_price_to_float(prices[ticket['eventId']]) * ticket['totalTickets'], 2)
+        assert ticket['fullName'] == users[user_ids.index(ticket['userId'])]['username']
+    for user_id, event_id in booked:
+        assert 1 <= sum(ticket['userId'] == user_id and ticket['eventId'] == event_id for ticket in tickets) <= generator.GENERATOR_TICKETS_PER_EVENT
+
+
+#Offline fixtures
+def export(directory, file_format, seed=7):
+    generator.export_fixtures(str(directory), file_format, seed, date.today())
+    return {collection: list(generator.read_fixture(path)) for collection, path in generator.fixture_files(str(directory))}
+
+def test_export_is_the_same_for_the_same_seed(db, tmp_path):
+    exported = export(tmp_path / 'first', 'jsonl')
+
+    assert sorted(exported) == sorted(generator.FIXTURE_COLLECTIONS)
+    assert len(exported['auth']) == len(exported['Users']) == generator.GENERATOR_USERS
+    assert export(tmp_path / 'second', 'jsonl') == exported
+    for collection in generator.FIXTURE_COLLECTIONS:
+        assert (tmp_path / 'first' / f'{collection}.jsonl').read_bytes() == (tmp_path / 'second' / f'{collection}.jsonl').read_bytes()
+    assert export(tmp_path / 'parquet', 'parquet') == exported
+    assert export(tmp_path / 'other', 'jsonl', seed=8) != exported
+    # An export never writes to the database
+    assert db.writes == 0
+
+def test_loaded_fixtures_match_the_export(db, tmp_path, monkeypatch):
+    exported = export(tmp_path / 'fixtures', 'parquet')
+    loaded = InMemoryFirestore()
+    monkeypatch.setattr(generator, 'get_database', lambda: loaded)
+
+    generator.load_fixtures(str(tmp_path / 'fixtures'), import_auth=False)
+
+    for collection in ['Users', 'events', 'savedEvents', 'tickets']:
+        documents = {document_id: data for document_id, (data, _) in loaded._documents(collection).items()}
+        assert documents == {row.pop(generator.FIXTURE_ID_FIELD): row for row in exported[collection]}
+    assert 'auth' not in loaded._collections
+
+def test_snapshots_feed_an_offline_recommendation_run(db, tmp_path, monkeypatch):
+    export(tmp_path / 'fixtures', 'jsonl')
+    generator.write_recommendation_snapshots(str(tmp_path / 'fixtures'), ml.SNAPSHOT_DIR)
+    monkeypatch.setattr(ml, 'SNAPSHOT_MODE', 'offline')
+    monkeypatch.setattr(ml, 'RECOMMENDATION_ENGINE', 'content')
+    monkeypatch.setattr(ml, 'RUN_MODE', 'full')
+    monkeypatch.setattr(ml, 'metrics', ml.RunMetrics())
+    monkeypatch.setattr(ml, 'get_database', lambda: pytest.fail('an offline run connected to the database'))
+
+    ml.main()
+
+    with open(ml.HOME_EVENTS_OUTPUT_PATH) as output:
+        home_events = [json.loads(line) for line in output]
+    assert len(home_events) == generator.GENERATOR_USERS
+    event_ids = set(ml.load_snapshot('events')['id'])
+    assert len(event_ids) == len(generator.cities_and_streets) * (generator.GENERATOR_EVENTS_PER_CITY - generator.GENERATOR_SAVED_EVENTS_PER_CITY)
+    assert all(set(user['homeEvents']) <= event_ids for user in home_events)
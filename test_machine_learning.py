@@ -0,0 +1,433 @@
+#run with python -m pytest -q
+#Tests of the recommendation pipeline against the in-memory Firestore
+
+import json
+from datetime import datetime, timezone
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from benchmark_recommendations import populate
+from in_memory_firestore import InMemoryFirestore
+import machine_learning as ml
+
+N_USERS = 60
+N_EVENTS = 80
+
+
+@pytest.fixture
+def db():
+    db = InMemoryFirestore()
+    populate(db, N_USERS, N_EVENTS, False, 0)
+    return db
+
+#Runs of main() read and write their state under tmp_path, against the given database
+@pytest.fixture
+def run_main(db, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ml, 'get_database', lambda: db)
+    monkeypatch.setattr(ml, 'RECOMMENDATION_ENGINE', 'als')
+
+    def run(run_mode='full'):
+        monkeypatch.setattr(ml, 'RUN_MODE', run_mode)
+        monkeypatch.setattr(ml, 'metrics', ml.RunMetrics())
+        written = []
+        add = ml.HomeEventsWriter.add
+
+        def recorded_add(writer, user_id, *args):
+            written.append(user_id)
+            return add(writer, user_id, *args)
+        monkeypatch.setattr(ml.HomeEventsWriter, 'add', recorded_add)
+        ml.main()
+        monkeypatch.setattr(ml.HomeEventsWriter, 'add', add)
+        return written
+    return run
+
+def home_events(db):
+    return {user_id: data.get('homeEvents') for user_id, (data, _) in db._documents('Users').items()}
+
+def users_frame(rows):
+    return pd.DataFrame([{'id': user_id, **{col: rows[user_id].get(col, []) for col in ml.INTERACTION_WEIGHTS}} for user_id in rows])
+
+def events_frame(rows):
+    return pd.DataFrame([
+        {'eventID': event_id, 'price': price, 'category': category, 'city': city, 'updateTime': update_time}
+        for event_id, price, category, city, update_time in rows
+    ])
+
+
+#Ranking
+def test_rank_top_k_orders_by_score_and_drops_excluded_events():
+    scores = np.array([
+        [0.1, 0.9, -np.inf, 0.5, 0.3],
+        [-np.inf, -np.inf, 0.2, -np.inf, -np.inf],
+    ], dtype=np.float32)
+
+    (first_positions, first_scores), (second_positions, second_scores) = ml.rank_top_k(scores, k=3)
+
+    assert first_positions.tolist() == [1, 3, 4]
+    assert first_scores.tolist() == pytest.approx([0.9, 0.5, 0.3])
+    assert second_positions.tolist() == [2]
+    assert second_scores.tolist() == pytest.approx([0.2])
+
+def test_rank_top_k_applies_min_score_and_short_rows():
+    scores = np.array([[0.4, -0.2, 0.0, 0.7]], dtype=np.float32)
+
+    [(positions, values)] = ml.rank_top_k(scores, k=10, min_score=0)
+
+    assert positions.tolist() == [3, 0]
+    assert values.tolist() == pytest.approx([0.7, 0.4])
+    assert [len(positions) for positions, _ in ml.rank_top_k(scores, k=0)] == [0]
+
+
+#Interaction matrix
+def test_build_interaction_matrix_weights():
+    event_ids = pd.Index(['e0', 'e1', 'e2', 'e3'])
+    users_df = users_frame({
+        'u0': {'likedEvents': ['e0'], 'bookmarkedEvents': ['e0', 'unknown'], 'dislikedEvents': ['e1'], 'myEvents': ['e2']},
+        'u1': {'likedEvents': ['e3'], 'dislikedEvents': ['e3']},
+    })
+
+    matrix = ml.build_interaction_matrix(users_df, event_ids)
+
+    assert matrix.toarray().tolist() == [[2, -1, 1, 0], [0, 0, 0, 0]]
+    assert matrix.nnz == 3
+    interned = ml.intern_interactions(users_df, event_ids)
+    assert (ml.build_interaction_matrix(interned, event_ids) != matrix).nnz == 0
+    seen = ml.build_interaction_matrix(users_df, event_ids, weights=ml.SEEN_WEIGHTS)
+    assert seen.toarray().tolist() == [[2, 1, 1, 0], [0, 0, 0, 2]]
+
+
+#Writes
+class FailingCommits:
+    def __init__(self, db, failures):
+        self.db = db
+        self.failures = list(failures)
+
+    def collection(self, name):
+        return self.db.collection(name)
+
+    def batch(self):
+        batch = self.db.batch()
+        commit = batch.commit
+
+        def failing_commit():
+            if self.failures:
+                raise self.failures.pop(0)
+            return commit()
+        batch.commit = failing_commit
+        return batch
+
+def test_home_events_writer_retries_retryable_errors(db, monkeypatch):
+    monkeypatch.setattr(ml.time, 'sleep', lambda seconds: None)
+    writer = ml.HomeEventsWriter(FailingCommits(db, [google_exceptions.ServiceUnavailable('busy')]), batch_size=10, max_workers=1)
+
+    for index in range(5):
+        writer.add(f'user{index:07d}', ['event0000001'])
+    stats = writer.close()
+
+    assert stats == {'succeeded': 5, 'failed': 0, 'retried': 5}
+    assert all(home_events(db)[f'user{index:07d}'] == ['event0000001'] for index in range(5))
+
+def test_home_events_writer_falls_back_to_single_users(db):
+    writer = ml.HomeEventsWriter(db, batch_size=10, max_workers=1)
+
+    writer.add('user0000000', ['event0000001'])
+    writer.add('missing', ['event0000002'])
+    writer.add('user0000001', ['event0000003'], [0.5])
+    stats = writer.close()
+
+    assert stats == {'succeeded': 2, 'failed': 1, 'retried': 0}
+    assert writer.failed_user_ids == ['missing']
+    assert home_events(db)['user0000000'] == ['event0000001']
+    assert db._documents('Users')['user0000001'][0]['homeEventScores'] == [0.5]
+
+
+#Feature store
+def test_feature_store_keeps_columns_stable_across_runs(tmp_path):
+    store_dir = str(tmp_path / 'features')
+    first_ids, first_features = ml.EventFeatureStore(store_dir).update(events_frame([
+        ('e0', '10', 'Music', 'Athens', 1.0),
+        ('e1', 'Free', 'Sports', 'Paris', 1.0),
+        ('e2', '30', 'Music', 'Paris', 1.0),
+    ]))
+    first_columns = ml.EventFeatureStore(store_dir).columns
+
+    second_store = ml.EventFeatureStore(store_dir)
+    second_ids, second_features = second_store.update(events_frame([
+        ('e0', '10', 'Music', 'Athens', 1.0),
+        ('e2', '30', 'Art', 'Rome', 2.0),
+        ('e3', '20', 'Art', 'Athens', 2.0),
+    ]))
+
+    assert second_store.columns[:len(first_columns)] == first_columns
+    assert second_store.columns[len(first_columns):] == ['category_Art', 'city_Rome']
+    assert first_ids.tolist() == ['e0', 'e1', 'e2']
+    assert second_ids.tolist() == ['e0', 'e2', 'e3']
+    # The unchanged event keeps its one-hot columns, the changed one is encoded again
+    assert second_features[0, 1:len(first_columns)].tolist() == first_features[0, 1:].tolist()
+    assert second_features[1, second_store.column_index['category_Art']] == 1
+    assert second_features[1, second_store.column_index['category_Music']] == 0
+    assert second_features[:, 0].tolist() == pytest.approx([0, 1, 0.5])
+
+
+#Incremental runs and checkpoints
+def test_incremental_run_only_recomputes_changed_users(db, run_main):
+    assert len(run_main('full')) == N_USERS
+    assert run_main('incremental') == []
+
+    user = db.collection('Users').document('user0000007')
+    liked_events = user.get().to_dict()['likedEvents']
+    user.update({'likedEvents': liked_events + ['event0000079']})
+    # Writing 'homeEvents' is an update of the document, but not of its interactions
+    db.collection('Users').document('user0000008').update({'homeEvents': []})
+
+    assert run_main('incremental') == ['user0000007']
+
+def test_incremental_run_sees_changes_made_during_the_fetch(db, run_main, monkeypatch):
+    fetch_collection_pages = ml.fetch_collection_pages
+
+    # After the first page of users is read, a user of that page gets a new like and a user of a
+    # later page is updated after it, so the latest update time fetched is past the missed change
+    def changing_pages(db, collection, page_size=ml.FETCH_PAGE_SIZE):
+        for page, docs in enumerate(fetch_collection_pages(db, collection, page_size=20)):
+            yield docs
+            if collection == 'Users' and page == 0:
+                db.collection('Users').document('user0000000').update({'likedEvents': ['event0000079']})
+                db.collection('Users').document('user0000050').update({'username': 'renamed'})
+    run_main('full')
+    monkeypatch.setattr(ml, 'fetch_collection_pages', changing_pages)
+    assert run_main('incremental') == []
+    monkeypatch.setattr(ml, 'fetch_collection_pages', fetch_collection_pages)
+
+    assert run_main('incremental') == ['user0000000']
+    assert run_main('incremental') == []
+
+def test_incremental_run_sees_edited_events(db, run_main):
+    run_main('full')
+    db.collection('events').document('event0000003').update({'category': 'Sports'})
+
+    # Unchanged 'homeEvents' are not written again, so the recomputed users are counted instead
+    run_main('incremental')
+    assert ml.metrics.counters['users_recomputed'] == N_USERS
+    run_main('incremental')
+    assert ml.metrics.counters['users_recomputed'] == 0
+
+def test_run_without_users(db, run_main, monkeypatch):
+    for user_id in list(db._documents('Users')):
+        db.collection('Users').document(user_id).delete()
+    monkeypatch.setattr(ml, 'SNAPSHOT_MODE', 'sync')
+
+    assert run_main('full') == []
+    assert run_main('incremental') == []
+    assert len(ml.load_snapshot('Users')) == 0
+
+def test_interrupted_run_resumes_from_checkpoint(db, run_main, monkeypatch):
+    monkeypatch.setattr(ml, 'CHECKPOINT_USERS', 10)
+    add = ml.HomeEventsWriter.add
+    added = []
+
+    def interrupted_add(writer, user_id, *args):
+        if len(added) == 25:
+            raise KeyboardInterrupt
+        added.append(user_id)
+        return add(writer, user_id, *args)
+    monkeypatch.setattr(ml.HomeEventsWriter, 'add', interrupted_add)
+    with pytest.raises(KeyboardInterrupt):
+        ml.main()
+    monkeypatch.setattr(ml.HomeEventsWriter, 'add', add)
+    with open(ml.CHECKPOINT_PATH) as checkpoint_file:
+        assert len(json.load(checkpoint_file)['users']) == 20
+
+    resumed = run_main('full')
+
+    assert len(resumed) == N_USERS - 20
+    assert not set(resumed) & set(added[:20])
+    assert not os.path.exists(ml.CHECKPOINT_PATH)
+    finished = home_events(db)
+    assert run_main('full') and home_events(db) == finished
+
+
+#Engines
+def test_per_user_pool_matches_serial(db, tmp_path):
+    events_df = ml.fetch_events_to_dataframe(db)
+    event_ids, event_features = ml.EventFeatureStore(str(tmp_path / 'features')).update(events_df)
+    users_df = ml.filter_users(ml.fetch_users_to_dataframe(db))
+    interaction_matrix = ml.build_interaction_matrix(users_df, event_ids)
+
+    def recommend(workers):
+        return {user_id: (event_ids, scores) for user_id, event_ids, scores in ml.recommend_per_user(
+            users_df, event_ids, event_features, interaction_matrix, workers=workers, chunk_size=16)}
+
+    serial = recommend(1)
+    assert len(serial) == len(users_df)
+    assert recommend(2) == serial
+
+
+#Catalogue pre-filter
+DEAD_EVENT_IDS = [f'event{index:07d}' for index in range(10)]
+
+def expire_events(db, event_ids):
+    for index, event_id in enumerate(event_ids):
+        change = {'availability': 0} if index % 2 else {'date': datetime(2020, 1, 1, tzinfo=timezone.utc)}
+        db.collection('events').document(event_id).update(change)
+
+@pytest.mark.parametrize('engine', ['per_user', 'als', 'content'])
+def test_home_events_never_hold_dead_events(db, run_main, monkeypatch, engine):
+    monkeypatch.setattr(ml, 'RECOMMENDATION_ENGINE', engine)
+    expire_events(db, DEAD_EVENT_IDS[:5])
+    run_main('full')
+    expire_events(db, DEAD_EVENT_IDS[5:])
+
+    # Events that ended since the last run are dropped by the next incremental one
+    run_main('incremental')
+
+    recommended = {event_id for events in home_events(db).values() for event_id in events}
+    assert recommended and not recommended & set(DEAD_EVENT_IDS)
+
+def test_live_event_mask_keeps_events_without_date_or_availability():
+    event_ids = pd.Index(['e0', 'e1', 'e2', 'e3'])
+    events_df = pd.DataFrame({
+        'eventID': ['e0', 'e1', 'e2', 'e3'],
+        'date': pd.to_datetime(['2030-01-01', '2020-01-01', None, '2030-01-01'], utc=True),
+        'availability': [10, 10, None, 0],
+    })
+
+    assert ml.live_event_mask(events_df, event_ids).tolist() == [True, False, True, False]
+
+
+#Geospatial candidates
+def candidate_events():
+    return pd.DataFrame({
+        'eventID': ['e0', 'e1', 'e2', 'e3', 'e4', 'e5'],
+        'latitude': [37.98, 37.99, 37.97, -33.87, -33.86, 0.0],
+        'longitude': [23.73, 23.72, 23.74, 151.21, 151.20, 0.0],
+    })
+
+def test_candidates_are_the_neighbours_of_positive_interactions():
+    event_ids = pd.Index(candidate_events()['eventID'])
+    matrix = ml.build_interaction_matrix(users_frame({
+        'u0': {'likedEvents': ['e0'], 'dislikedEvents': ['e3']},
+        'u1': {'dislikedEvents': ['e3']},
+        'u2': {'bookmarkedEvents': ['e3']},
+    }), event_ids)
+
+    mask, fallback = ml.CandidateIndex(candidate_events(), event_ids, radius_km=50, min_count=1).candidates(matrix, np.arange(3))
+
+    # The event at (0, 0) has no location and is a candidate for everyone; a disliked event is no anchor
+    assert mask[0].toarray().ravel().tolist() == [True, True, True, False, False, True]
+    assert mask[2].toarray().ravel().tolist() == [False, False, False, True, True, True]
+    assert fallback.tolist() == [False, True, False]
+
+def test_candidates_fall_back_below_min_count():
+    event_ids = pd.Index(candidate_events()['eventID'])
+    matrix = ml.build_interaction_matrix(users_frame({
+        'u0': {'likedEvents': ['e0', 'e1']},
+        'u1': {'likedEvents': ['e3']},
+    }), event_ids)
+
+    _, fallback = ml.CandidateIndex(candidate_events(), event_ids, radius_km=50, min_count=2).candidates(matrix, np.arange(2))
+
+    # u0 has e2 and the unlocated event left as new candidates, u1 has only e4 and the unlocated one
+    assert fallback.tolist() == [False, False]
+    _, fallback = ml.CandidateIndex(candidate_events(), event_ids, radius_km=50, min_count=3).candidates(matrix, np.arange(2))
+    assert fallback.tolist() == [True, True]
+
+@pytest.mark.parametrize('engine', ['per_user', 'als', 'content'])
+def test_engines_only_recommend_candidates(db, tmp_path, engine):
+    events_df = ml.fetch_events_to_dataframe(db)
+    event_ids, event_features = ml.EventFeatureStore(str(tmp_path / 'features')).update(events_df)
+    cities = events_df.set_index('eventID')['city']
+    # Three users per city like and bookmark two of its events, and dislike one of the next city
+    by_city = {city: list(city_events.index) for city, city_events in cities.groupby(cities)}
+    city_names = sorted(by_city)
+    users_df = users_frame({
+        f'u{index}': {
+            'likedEvents': by_city[city_names[index % len(city_names)]][index // len(city_names):][:2],
+            'bookmarkedEvents': by_city[city_names[index % len(city_names)]][index // len(city_names):][:2],
+            'dislikedEvents': by_city[city_names[(index + 1) % len(city_names)]][:1],
+        }
+        for index in range(3 * len(city_names))
+    })
+    interaction_matrix = ml.build_interaction_matrix(users_df, event_ids)
+    candidate_index = ml.CandidateIndex(events_df, event_ids, radius_km=100, min_count=1)
+
+    recommendations = list(ml.RECOMMENDATION_ENGINES[engine](users_df, event_ids, event_features, interaction_matrix, candidate_index=candidate_index))
+
+    assert len(recommendations) == len(users_df)
+    for user_id, recommended_event_ids, _ in recommendations:
+        assert recommended_event_ids
+        liked_city = cities[users_df.set_index('id').loc[user_id, 'likedEvents'][0]]
+        assert set(cities[recommended_event_ids]) <= {liked_city}
+
+def engine_inputs(db, tmp_path):
+    events_df = ml.fetch_events_to_dataframe(db)
+    event_ids, event_features = ml.EventFeatureStore(str(tmp_path / 'features')).update(events_df)
+    users_df = ml.filter_users(ml.fetch_users_to_dataframe(db))
+    return users_df, event_ids, event_features, ml.build_interaction_matrix(users_df, event_ids)
+
+def test_content_ranks_unseen_events_by_cosine_similarity(db, tmp_path):
+    users_df, event_ids, event_features, interaction_matrix = engine_inputs(db, tmp_path)
+    event_vectors = ml.unit_rows(np.asarray(event_features, dtype=np.float32))
+    profiles = ml.unit_rows(np.asarray(interaction_matrix @ event_features, dtype=np.float32))
+    position = {event_id: index for index, event_id in enumerate(event_ids)}
+
+    recommendations = list(ml.recommend_content(users_df, event_ids, event_features, interaction_matrix, block_size=16))
+
+    assert [user_id for user_id, _, _ in recommendations] == users_df['id'].tolist()
+    for row, (user_id, recommended_event_ids, scores) in enumerate(recommendations):
+        seen = {event_id for col in ml.INTERACTION_WEIGHTS for event_id in users_df.iloc[row][col]}
+        assert recommended_event_ids and not set(recommended_event_ids) & seen
+        assert scores == sorted(scores, reverse=True) and scores[-1] > 0
+        expected = [float(event_vectors[position[event_id]] @ profiles[row]) for event_id in recommended_event_ids]
+        assert scores == pytest.approx(expected, abs=1e-5)
+
+def test_content_ann_index_probing_every_list_is_exact(db, tmp_path):
+    users_df, event_ids, event_features, interaction_matrix = engine_inputs(db, tmp_path)
+    live_events = np.arange(len(event_ids)) % 4 != 0
+    live_event_ids = set(event_ids[live_events])
+
+    def recommend(**options):
+        return list(ml.recommend_content(users_df, event_ids, event_features, interaction_matrix, live_events=live_events, **options))
+    exact = recommend()
+    approximate = recommend(ann_lists=6, ann_probes=6)
+    probed = recommend(content_index=ml.build_content_index(event_features, live_events, ann_lists=6, ann_probes=2))
+
+    for (_, exact_ids, exact_scores), (_, ann_ids, ann_scores) in zip(exact, approximate):
+        assert set(exact_ids) <= live_event_ids and set(ann_ids) <= live_event_ids
+        assert ann_scores == pytest.approx(exact_scores, abs=1e-5)
+    # Probing fewer lists only leaves events out, and never brings in a seen or ended one
+    exact_scores = {(user_id, event_id): score for user_id, ranked_ids, scores in recommend(k=len(event_ids)) for event_id, score in zip(ranked_ids, scores)}
+    for user_id, probed_ids, probed_scores in probed:
+        assert [exact_scores[user_id, event_id] for event_id in probed_ids] == pytest.approx(probed_scores, abs=1e-5)
+    assert probed != exact
+
+
+#Snapshots
+def comparable(users_df):
+    users_df = users_df.sort_values('id', ignore_index=True)
+    return {col: [list(value) if isinstance(value, (list, np.ndarray)) else value for value in users_df[col]] for col in ['id', 'updateTime', *ml.COLLECTION_SCHEMAS['Users'].names]}
+
+def test_snapshot_sync_fetches_only_changed_documents(db, tmp_path, monkeypatch):
+    snapshot_dir = str(tmp_path / 'snapshots')
+    monkeypatch.setattr(ml, 'metrics', ml.RunMetrics())
+    ml.sync_snapshot(db, 'Users', snapshot_dir)
+    assert ml.metrics.counters['firestore_reads'] == N_USERS
+
+    users = db.collection('Users')
+    users.document('user0000003').update({'likedEvents': ['event0000001']})
+    users.document('user0000004').update({'username': 'renamed'})
+    users.document('user0000005').delete()
+    users.document('user9999999').set(users.document('user0000006').get().to_dict())
+    monkeypatch.setattr(ml, 'metrics', ml.RunMetrics())
+    ml.sync_snapshot(db, 'Users', snapshot_dir)
+
+    # One listing of the document ids, then the two changed documents and the new one
+    assert ml.metrics.counters['firestore_reads'] == N_USERS + 3
+    assert comparable(ml.load_snapshot('Users', snapshot_dir)) == comparable(ml.fetch_users_to_dataframe(db))
+    monkeypatch.setattr(ml, 'metrics', ml.RunMetrics())
+    ml.sync_snapshot(db, 'Users', snapshot_dir)
+    assert ml.metrics.counters['firestore_reads'] == N_USERS
@@ -0,0 +1,106 @@
+#run with python -m pytest -q
+#Tests of the real-time daemon against the in-memory Firestore
+
+import threading
+import time
+
+import pytest
+
+from benchmark_recommendations import populate
+from in_memory_firestore import InMemoryFirestore
+import machine_learning as ml
+from recommendation_daemon import RecommendationDaemon
+
+N_USERS = 40
+N_EVENTS = 60
+DEBOUNCE_SECONDS = 0.3
+
+
+#A started daemon running on a background thread, with every round recorded as the collections it served
+@pytest.fixture
+def daemon(tmp_path, monkeypatch):
+    db = InMemoryFirestore()
+    populate(db, N_USERS, N_EVENTS, False, 0)
+    monkeypatch.setattr(ml, 'metrics', ml.RunMetrics())
+    daemon = RecommendationDaemon(
+        db, engine='content', snapshot_dir=str(tmp_path / 'snapshots'), state_path=str(tmp_path / 'run_state.json'),
+        store_dir=str(tmp_path / 'features'), metrics_path=str(tmp_path / 'metrics.json'),
+        debounce_seconds=DEBOUNCE_SECONDS, max_delay_seconds=10, events_debounce_seconds=DEBOUNCE_SECONDS,
+    )
+    daemon.rounds = []
+    rescore = daemon.rescore
+
+    def recorded_rescore(collections):
+        rescored = ml.metrics.counters.get('daemon_users_rescored', 0)
+        rescore(collections)
+        daemon.rounds.append((sorted(collections), ml.metrics.counters.get('daemon_users_rescored', 0) - rescored))
+    daemon.rescore = recorded_rescore
+
+    daemon.start()
+    thread = threading.Thread(target=daemon.run, kwargs={'checkpoint_seconds': 60})
+    thread.start()
+    wait_for(lambda: daemon.rounds)
+    yield daemon
+    daemon.stop()
+    thread.join()
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+#Waits long enough for any pending change to have been served
+def settle():
+    time.sleep(3 * DEBOUNCE_SECONDS)
+
+
+def test_first_round_scores_every_user(daemon):
+    settle()
+
+    assert daemon.rounds == [(['Users', 'events'], N_USERS)]
+    assert all(data.get('homeEvents') for data, _ in daemon.db._documents('Users').values())
+
+def test_burst_of_changes_is_one_round(daemon):
+    settle()
+    users = daemon.db.collection('Users')
+    for index in range(3):
+        users.document(f'user{index:07d}').update({'likedEvents': [f'event{N_EVENTS - 1 - index:07d}']})
+        time.sleep(DEBOUNCE_SECONDS / 4)
+    settle()
+
+    assert daemon.rounds[1:] == [(['Users'], 3)]
+
+def test_home_events_writes_do_not_trigger_a_round(daemon):
+    settle()
+    users = daemon.db.collection('Users')
+    users.document('user0000001').update({'homeEvents': []})
+    users.document('user0000002').update({'username': 'renamed'})
+    settle()
+
+    assert daemon.rounds[1:] == []
+
+def test_event_change_rescores_every_user(daemon):
+    settle()
+    daemon.db.collection('events').document('event0000003').update({'category': 'Sports'})
+    settle()
+
+    assert daemon.rounds[1:] == [(['events'], N_USERS)]
+
+def test_stopped_daemon_starts_warm(daemon, tmp_path):
+    settle()
+    daemon.stop()
+    wait_for(lambda: (tmp_path / 'run_state.json').exists())
+    daemon.db.collection('Users').document('user0000004').update({'dislikedEvents': ['event0000000']})
+
+    restarted = RecommendationDaemon(
+        daemon.db, engine='content', snapshot_dir=str(tmp_path / 'snapshots'), state_path=str(tmp_path / 'run_state.json'),
+        store_dir=str(tmp_path / 'features'), metrics_path=str(tmp_path / 'metrics.json'),
+    )
+    restarted.start()
+    wait_for(lambda: len(restarted.synced) == 2)
+    restarted.rescore(('events', 'Users'))
+    for watch in restarted.watches:
+        watch.unsubscribe()
+
+    assert ml.metrics.counters['daemon_users_rescored'] == N_USERS + 1
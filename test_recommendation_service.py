@@ -0,0 +1,112 @@
+#run with python -m pytest -q
+#Tests of the HTTP recommendation service against the in-memory Firestore
+
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from benchmark_recommendations import populate
+from in_memory_firestore import InMemoryFirestore
+import machine_learning as ml
+import recommendation_service
+from recommendation_service import RecommendationService, make_server
+from test_recommendation_daemon import wait_for
+
+N_USERS = 40
+N_EVENTS = 120
+
+
+#A started service on a free port, serving requests once its first catalogue is loaded
+@pytest.fixture(params=['content'])
+def service(request, tmp_path, monkeypatch):
+    db = InMemoryFirestore()
+    populate(db, N_USERS, N_EVENTS, False, 0)
+    monkeypatch.setattr(ml, 'metrics', ml.RunMetrics())
+    service = RecommendationService(
+        db, engine=request.param, metrics_path=str(tmp_path / 'metrics.json'), store_dir=str(tmp_path / 'features'),
+        debounce_seconds=0.1, events_debounce_seconds=0.1,
+    )
+    server = make_server(service, '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    service.start()
+    thread = threading.Thread(target=service.run, kwargs={'checkpoint_seconds': 60})
+    thread.start()
+    service.ready.wait(10)
+    service.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield service
+    service.stop()
+    thread.join()
+    server.shutdown()
+
+def get(service, path):
+    try:
+        with urllib.request.urlopen(service.url + path) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as error:
+        return error.code, json.load(error)
+
+def seen_events(service, user_id):
+    data = service.db.collection('Users').document(user_id).get().to_dict()
+    return {event_id for col in ml.INTERACTION_WEIGHTS for event_id in data.get(col, [])}
+
+
+def test_results_are_cached_until_the_user_changes(service):
+    status, first = get(service, '/recommendations/user0000001')
+    assert status == 200 and first['eventIds'] and not first['cached'] and not first['coldStart']
+    assert get(service, '/recommendations/user0000001')[1]['cached']
+
+    liked_event_id = first['eventIds'][0]
+    service.db.collection('Users').document('user0000001').update({'likedEvents': [liked_event_id]})
+    wait_for(lambda: 'user0000001' not in service.cache.entries)
+
+    status, changed = get(service, '/recommendations/user0000001')
+    assert status == 200 and not changed['cached']
+    assert liked_event_id not in changed['eventIds']
+
+def test_event_changes_clear_the_cache(service):
+    get(service, '/recommendations/user0000001')
+    assert len(service.cache) == 1
+
+    service.db.collection('events').document('event0000003').update({'category': 'Sports'})
+    wait_for(lambda: len(service.cache) == 0)
+
+def test_limits(service):
+    status, limited = get(service, '/recommendations/user0000002?limit=5')
+    assert status == 200 and len(limited['eventIds']) == len(limited['scores']) == 5
+    # The entry holds HOME_EVENTS_LIMIT events, so smaller limits are served from it
+    assert get(service, '/recommendations/user0000002?limit=10')[1]['cached']
+
+    status, more = get(service, '/recommendations/user0000002?limit=30')
+    assert status == 200 and not more['cached']
+    assert more['eventIds'][:ml.HOME_EVENTS_LIMIT] == get(service, '/recommendations/user0000002')[1]['eventIds']
+
+    for limit in [recommendation_service.SERVICE_MAX_LIMIT + 1, -1, 'ten']:
+        assert get(service, f'/recommendations/user0000002?limit={limit}')[0] == 400
+    assert get(service, '/recommendations/nobody')[0] == 404
+    assert get(service, '/unknown')[0] == 404
+
+def test_users_without_interactions_get_popular_events(service):
+    service.db.collection('Users').document('newcomer').set({'username': 'newcomer'})
+
+    status, result = get(service, '/recommendations/newcomer')
+
+    popular_event_ids, interaction_counts = service.served[-1]
+    assert status == 200 and result['coldStart']
+    assert result['eventIds'] == popular_event_ids[:ml.HOME_EVENTS_LIMIT]
+    assert result['scores'] == sorted(result['scores'], reverse=True) == interaction_counts[:ml.HOME_EVENTS_LIMIT]
+
+@pytest.mark.parametrize('service', ['per_user'], indirect=True)
+def test_users_the_engine_cannot_rank_get_unseen_popular_events(service):
+    users = service.db.collection('Users')
+    users.document('user0000003').update({'dislikedEvents': [], 'bookmarkedEvents': [], 'myEvents': []})
+    wait_for(lambda: not len(service.records['Users']['user0000003']['dislikedEvents']))
+
+    status, result = get(service, '/recommendations/user0000003')
+
+    # Only liked events give the per-user model a single class to learn from
+    assert status == 200 and result['coldStart'] and result['eventIds']
+    assert not set(result['eventIds']) & seen_events(service, 'user0000003')
+    assert get(service, '/recommendations/user0000003')[1]['cached']